@@ -1,9 +1,12 @@
 import os
+import copy
+import hashlib
 from os.path import split
-from functools import partial
+from functools import partial, lru_cache
+from collections import OrderedDict
 
 import numpy as np
-from scipy import sparse, signal
+from scipy import sparse
 from scipy.io import loadmat
 
 import mne
@@ -14,12 +17,27 @@ from borsar.utils import find_index
 from borsar.cluster import Clusters, construct_adjacency_matrix
 
 from . import utils
-from .stats import ttest_ind_no_p, ttest_rel_no_p
+from .stats import (ttest_ind_no_p, ttest_rel_no_p, ttest_1samp_sign_flip_no_p,
+                    ttest_ind_permuted_no_p, ttest_1samp_from_sums,
+                    ttest_ind_from_sums)
 
 
 base_dir = split(__file__)[0]
 chan_path = os.path.join(base_dir, 'data', 'chan')
 
+# relative tolerance used when comparing observed and null statistics
+_TOLERANCE = 1e-10
+
+
+# directory where computed channel adjacency is stored
+adjacency_cache_dir = os.environ.get(
+    'SARNA_CACHE', os.path.join(os.path.expanduser('~'), '.sarna',
+                                'adjacency'))
+
+# in-memory cache of adjacency (least recently used entries are dropped)
+_adjacency_memory = OrderedDict()
+_ADJACENCY_MEMORY_SIZE = 32
+
 
 # read channel connectivity
 # consider renaming to read_neighbours
@@ -30,16 +48,155 @@ def get_neighbours(captype):
         file_name = captype
     else:
         # cap type was given
-        fls = [f for f in os.listdir(chan_path) if f.endswith('.mat') and
-               '_neighbours' in f]
-        good_file = [f for f in fls if captype in f]
+        good_file = [f for f in _neighbours_files() if captype in f]
         if len(good_file) > 0:
             file_name = os.path.join(chan_path, good_file[0])
         else:
             raise ValueError('Could not find specified cap type.')
+    # the file is read again when it was modified; a deep copy is returned so
+    # that the cached structure (also its neighblabel arrays) cannot be
+    # modified
+    file_name = os.path.abspath(file_name)
+    file_stat = os.stat(file_name)
+    neighbours = _read_neighbours(file_name, file_stat.st_mtime_ns,
+                                  file_stat.st_size)
+    return copy.deepcopy(neighbours)
+
+
+@lru_cache(maxsize=None)
+def _neighbours_files():
+    '''List neighbours files bundled with sarna.'''
+    return tuple(f for f in sorted(os.listdir(chan_path))
+                 if f.endswith('.mat') and '_neighbours' in f)
+
+
+@lru_cache(maxsize=16)
+def _read_neighbours(file_name, mtime, size):
+    '''Read neighbours structure, cached on file path, modification time
+    and size.'''
     return loadmat(file_name, squeeze_me=True)['neighbours']
 
 
+def read_adjacency(captype, cache=True):
+    '''Read channel adjacency for given cap type as sparse matrix.
+
+    Parameters
+    ----------
+    captype : str
+        Cap type (for example ``'BioSemi64'``) or path to FieldTrip neighbours
+        file.
+    cache : bool
+        Whether to use the adjacency cache. Defaults to ``True``.
+
+    Returns
+    -------
+    adjacency : scipy.sparse.csr_matrix
+        Boolean channel adjacency matrix.
+    ch_names : list of str
+        Channel names corresponding to rows / columns of the adjacency matrix.
+    '''
+    neighbours = get_neighbours(captype)
+    ch_names = neighbours['label'].tolist()
+    key = _montage_key(ch_names, kind='neighbours', neighbours=neighbours)
+
+    if cache:
+        try:
+            return _get_cached_adjacency(key)
+        except FileNotFoundError:
+            pass
+
+    adjacency = sparse.csr_matrix(construct_adjacency_matrix(
+        neighbours, as_sparse=True), dtype='bool')
+    if cache:
+        _save_adjacency(key, adjacency, ch_names)
+    return adjacency, ch_names
+
+
+def fill_adjacency_cache():
+    '''Store adjacency of all neighbours files bundled with sarna in cache.
+
+    Returns
+    -------
+    captypes : list of str
+        Cap types that were added to the cache.
+    '''
+    captypes = [f.replace('_neighbours.mat', '') for f in _neighbours_files()]
+    for captype in captypes:
+        read_adjacency(captype)
+    return captypes
+
+
+def _montage_key(ch_names, pos=None, kind='delaunay', neighbours=None):
+    '''Hash channel names and positions (or neighbours structure) into
+    adjacency cache key.'''
+    hsh = hashlib.sha1(kind.encode())
+    hsh.update('\n'.join(ch_names).encode())
+    if neighbours is not None:
+        # neighbours of each channel, so that edited neighbours files with
+        # the same channels do not share the key
+        for label, ngb in zip(neighbours['label'], neighbours['neighblabel']):
+            ngb = ','.join(np.atleast_1d(ngb).astype(str).tolist())
+            hsh.update('\n{}:{}'.format(label, ngb).encode())
+    if pos is not None:
+        # round to avoid differences due to floating point noise
+        pos = np.round(np.asarray(pos, dtype='float64'), decimals=8) + 0.
+        hsh.update(np.ascontiguousarray(pos).tobytes())
+    return hsh.hexdigest()
+
+
+def _adjacency_fname(key):
+    return os.path.join(adjacency_cache_dir, key + '.npz')
+
+
+def _read_cached_adjacency(key):
+    '''Read adjacency from disk cache, raises FileNotFoundError if absent.'''
+    with np.load(_adjacency_fname(key)) as data:
+        adjacency = sparse.csr_matrix(
+            (data['data'], data['indices'], data['indptr']),
+            shape=tuple(data['shape']))
+        ch_names = data['ch_names'].tolist()
+    return adjacency, tuple(ch_names)
+
+
+def _get_cached_adjacency(key):
+    '''Get adjacency from memory or disk cache, raises FileNotFoundError if
+    absent.'''
+    if key in _adjacency_memory:
+        _adjacency_memory.move_to_end(key)
+    else:
+        _remember_adjacency(key, *_read_cached_adjacency(key))
+    adjacency, ch_names = _adjacency_memory[key]
+    return adjacency.copy(), list(ch_names)
+
+
+def _remember_adjacency(key, adjacency, ch_names):
+    '''Keep adjacency in the in-memory cache, dropping the least recently
+    used entry when the cache is full.'''
+    _adjacency_memory[key] = (adjacency, tuple(ch_names))
+    _adjacency_memory.move_to_end(key)
+    if len(_adjacency_memory) > _ADJACENCY_MEMORY_SIZE:
+        _adjacency_memory.popitem(last=False)
+
+
+def _save_adjacency(key, adjacency, ch_names):
+    '''Save sparse adjacency to the memory and disk cache.'''
+    _remember_adjacency(key, adjacency.copy(), ch_names)
+    fname = _adjacency_fname(key)
+    try:
+        os.makedirs(adjacency_cache_dir, exist_ok=True)
+        # write to a temporary file first so that parallel processes never
+        # read partially written cache files
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'wb') as fid:
+            np.savez(fid, data=adjacency.data, indices=adjacency.indices,
+                     indptr=adjacency.indptr, shape=adjacency.shape,
+                     ch_names=np.array(ch_names))
+        os.replace(tmp_fname, fname)
+    except OSError:
+        # read-only file system etc. - the adjacency is still kept in memory
+        pass
+
+
 # - [ ] add edit option (runs in interactive mode only)
 # - [ ] new lines should have one color
 # - [x] 'random' is actually misleading - it follows colorcycle...
@@ -195,20 +352,58 @@ def plot_neighbours(inst, adj_matrix, color='gray', kind='3d'):
     return fig
 
 
-def find_adjacency(inst, picks=None):
-    '''Find channel adjacency matrix.'''
-    from scipy.spatial import Delaunay
+def find_adjacency(inst, picks=None, cache=True):
+    '''Find channel adjacency matrix.
+
+    The adjacency is found with Delaunay triangulation of the channel
+    positions. Results are cached on disk (in ``adjacency_cache_dir``) and in
+    memory, keyed on channel names and positions.
+
+    Parameters
+    ----------
+    inst : mne Raw, Epochs, Evoked or TFR object
+        Object with channel information.
+    picks : array of int | None
+        Channels to use. Defaults to ``None`` which uses all channels.
+    cache : bool
+        Whether to use the adjacency cache. Defaults to ``True``.
+
+    Returns
+    -------
+    adjacency : numpy array
+        Boolean channel adjacency matrix.
+    ch_names : list of str
+        Channel names corresponding to rows / columns of the adjacency matrix.
+    '''
     from mne.channels.layout import _find_topomap_coords
-    try:
-        from mne.source_estimate import spatial_tris_connectivity as adjacency
-    except:
-        from mne.source_estimate import spatial_tris_adjacency as adjacency
 
     n_channels = len(inst.ch_names)
     picks = np.arange(n_channels) if picks is None else picks
     ch_names = [inst.info['ch_names'][pick] for pick in picks]
     xy = _find_topomap_coords(inst.info, picks)
 
+    key = _montage_key(ch_names, xy)
+    if cache:
+        try:
+            adjacency, _ = _get_cached_adjacency(key)
+            return adjacency.toarray(), ch_names
+        except FileNotFoundError:
+            pass
+
+    adjacency = _delaunay_adjacency(xy)
+    if cache:
+        _save_adjacency(key, sparse.csr_matrix(adjacency), ch_names)
+    return adjacency, ch_names
+
+
+def _delaunay_adjacency(xy):
+    '''Channel adjacency from two Delaunay triangulations of positions.'''
+    from scipy.spatial import Delaunay
+    try:
+        from mne.source_estimate import spatial_tris_connectivity as adjacency
+    except:
+        from mne.source_estimate import spatial_tris_adjacency as adjacency
+
     # first on 2x, y
     coords = xy.copy()
     coords[:, 0] *= 2
@@ -221,16 +416,253 @@ def find_adjacency(inst, picks=None):
     tri = Delaunay(coords)
     neighbors2 = adjacency(tri.simplices)
 
-    adjacency = neighbors1.toarray() | neighbors2.toarray()
-    return adjacency, ch_names
+    return neighbors1.toarray() | neighbors2.toarray()
+
+
+def lattice_adjacency(adjacency, n_freqs, n_times, diagonal=False,
+                      temporal_only=False):
+    '''Construct sparse adjacency of the channels x frequencies x time graph.
+
+    The adjacency can be built once and then used for clustering of all
+    statistical maps of given shape (for example the observed and permuted
+    maps in ``permutation_cluster_ttest``).
+
+    Parameters
+    ----------
+    adjacency : boolean array | sparse array
+        Channel adjacency matrix.
+    n_freqs : int
+        Number of frequencies.
+    n_times : int
+        Number of time points.
+    diagonal : bool
+        Whether points are also adjacent to their diagonal neighbours in the
+        frequency x time plane (for example ``(freq + 1, time + 1)``).
+        Defaults to ``False``.
+    temporal_only : bool
+        Whether points of neighbouring frequencies are not adjacent - so that
+        the adjacency is defined only by channels and time. Defaults to
+        ``False``.
+
+    Returns
+    -------
+    adjacency : scipy.sparse.csr_matrix
+        Boolean adjacency matrix of shape ``(n_points, n_points)``, where
+        ``n_points = n_channels * n_freqs * n_times``. Points are ordered as
+        in a flattened ``(n_channels, n_freqs, n_times)`` array.
+    '''
+    def neighbours(n):
+        return sparse.diags([np.ones(n - 1), np.ones(n - 1)], [-1, 1],
+                            shape=(n, n), format='csr')
+
+    chan_adj = sparse.csr_matrix(adjacency, dtype=float)
+    chan_adj.setdiag(0)
+    n_chans = chan_adj.shape[0]
+    eye_chan, eye_freq, eye_time = [sparse.identity(n, format='csr')
+                                    for n in (n_chans, n_freqs, n_times)]
+    freq_adj, time_adj = neighbours(n_freqs), neighbours(n_times)
+
+    parts = [sparse.kron(sparse.kron(chan_adj, eye_freq), eye_time),
+             sparse.kron(eye_chan, sparse.kron(eye_freq, time_adj))]
+    if not temporal_only:
+        parts.append(sparse.kron(eye_chan, sparse.kron(freq_adj, eye_time)))
+        if diagonal:
+            parts.append(sparse.kron(eye_chan,
+                                     sparse.kron(freq_adj, time_adj)))
+
+    lattice = parts[0]
+    for part in parts[1:]:
+        lattice = lattice + part
+    lattice = sparse.csr_matrix(lattice, dtype=bool)
+    lattice.eliminate_zeros()
+    return lattice
+
+
+def _is_lattice_adjacency(adjacency, data):
+    '''Check whether adjacency describes all points of data (and not only
+    channels).'''
+    return (sparse.issparse(adjacency) and data.ndim > 1
+            and adjacency.shape[0] == data.size)
+
+
+def _cluster_lattice(data, adjacency, min_adj_ch=0):
+    '''Cluster boolean data given sparse adjacency of all data points (see
+    ``lattice_adjacency``).'''
+    from scipy.sparse.csgraph import connected_components
+
+    if min_adj_ch > 0:
+        raise ValueError('min_adj_ch can not be used with adjacency of all '
+                         'data points.')
+
+    clusters = np.zeros(data.shape, dtype='int')
+    idx = np.flatnonzero(data)
+    if idx.shape[0] > 0:
+        sub_adjacency = adjacency[idx][:, idx]
+        _, labels = connected_components(sub_adjacency, directed=False)
+        clusters.ravel()[idx] = labels + 1
+    return clusters
 
 
 def cluster(data, adjacency=None, min_adj_ch=0):
+    if _is_lattice_adjacency(adjacency, data):
+        return _cluster_lattice(data, adjacency, min_adj_ch=min_adj_ch)
+
     from borsar.cluster.label import _get_cluster_fun
     clst_fun = _get_cluster_fun(data, adjacency, min_adj_ch=min_adj_ch)
     return clst_fun(data, adjacency, min_adj_ch=min_adj_ch)
 
 
+def label_clusters(stat, threshold, adjacency=None, min_adj_ch=0,
+                   return_sizes=False, return_peaks=False, backend='auto'):
+    '''Label positive and negative clusters and compute their statistics.
+
+    Cluster statistics are computed from the label array in one pass
+    (``np.bincount``), without creating a boolean mask for every cluster.
+
+    Parameters
+    ----------
+    stat : numpy array
+        Statistical map.
+    threshold : float
+        Cluster entry threshold. Points above ``threshold`` form positive
+        clusters, points below ``-threshold`` form negative clusters.
+    adjacency : boolean array | sparse array | None
+        Channel adjacency matrix or sparse adjacency of all data points (see
+        ``lattice_adjacency``).
+    min_adj_ch : int
+        Minimum number of adjacent in-cluster channels to retain a point in
+        the cluster.
+    return_sizes : bool
+        Whether to also return the number of points in each cluster. Defaults
+        to ``False``.
+    return_peaks : bool
+        Whether to also return the peak value of each cluster (maximum for
+        positive and minimum for negative clusters). Defaults to ``False``.
+    backend : str
+        Clustering backend used with channel adjacency (see
+        ``borsar.cluster.find_clusters``). Defaults to ``'auto'``.
+
+    Returns
+    -------
+    labels : numpy array
+        Integer array of the same shape as ``stat``. ``0`` marks points that
+        do not belong to any cluster, cluster ``idx`` (counting from zero) is
+        marked with ``idx + 1``. Positive clusters are labeled first.
+    masses : numpy array
+        Sum of ``stat`` in each cluster.
+    sizes : numpy array
+        Number of points in each cluster. Returned only if
+        ``return_sizes=True``.
+    peaks : numpy array
+        Peak value of each cluster. Returned only if ``return_peaks=True``.
+    '''
+    if _is_lattice_adjacency(adjacency, stat):
+        cluster_fun = _cluster_lattice
+    else:
+        from borsar.cluster.label import _get_cluster_fun
+        if sparse.issparse(adjacency):
+            adjacency = adjacency.toarray()
+        cluster_fun = _get_cluster_fun(stat, adjacency=adjacency,
+                                       backend=backend, min_adj_ch=min_adj_ch)
+
+    labels = _label_clusters(stat, threshold, adjacency, cluster_fun,
+                             min_adj_ch=min_adj_ch)
+    n_clusters = labels.max()
+    flat_labels = labels.ravel()
+    masses = np.bincount(flat_labels, weights=stat.ravel(),
+                         minlength=n_clusters + 1)[1:]
+
+    out = [labels, masses]
+    if return_sizes:
+        out.append(np.bincount(flat_labels, minlength=n_clusters + 1)[1:])
+    if return_peaks:
+        # cluster signs are known from the masses
+        out.append(_cluster_stats(labels, stat, cluster_stat='max',
+                                  signs=np.sign(masses)))
+    return tuple(out)
+
+
+def _label_clusters(stat, threshold, adjacency, cluster_fun, min_adj_ch=0):
+    '''Label positive and negative clusters in one label array, positive
+    clusters first. Labels are consecutive integers starting from ``1``.'''
+    labels = np.zeros(stat.shape, dtype='int64')
+    n_clusters = 0
+    for mask in [stat > threshold, stat < -threshold]:
+        if not mask.any():
+            continue
+
+        tail_labels = cluster_fun(mask, adjacency=adjacency,
+                                  min_adj_ch=min_adj_ch)
+        in_cluster = tail_labels > 0
+        if not in_cluster.any():
+            continue
+
+        # the labels do not have to be consecutive (for example when points
+        # were removed with min_adj_ch), so they are renumbered
+        present = np.bincount(tail_labels[in_cluster]) > 0
+        present[0] = False
+        label_map = np.zeros(present.shape[0], dtype='int64')
+        n_tail = present.sum()
+        label_map[present] = np.arange(n_clusters + 1,
+                                       n_clusters + n_tail + 1)
+        labels[in_cluster] = label_map[tail_labels[in_cluster]]
+        n_clusters += n_tail
+    return labels
+
+
+def _cluster_stats(labels, stat, cluster_stat='mass', signs=None):
+    '''Compute statistic of each cluster from the cluster label array.
+
+    Each statistic is computed in one pass over the points.
+
+    Parameters
+    ----------
+    labels : numpy array
+        Integer cluster labels, ``0`` marks points outside of clusters.
+    stat : numpy array
+        Statistical map.
+    cluster_stat : str
+        ``'mass'`` (sum of the statistic), ``'size'`` (number of points) or
+        ``'max'`` (peak value of the statistic). Sizes of negative clusters
+        are negative, so that all three can be used with two-tailed null
+        distributions.
+    signs : numpy array | None
+        Signs of the clusters, if already known (for example from cluster
+        masses). Used only with ``cluster_stat='max'``. If ``None`` the sign
+        of each cluster is taken from one of its points.
+
+    Returns
+    -------
+    cluster_stats : numpy array
+        Statistic of each label (starting with label ``1``). Labels without
+        any points get ``0.``.
+    '''
+    flat_labels, flat_stat = labels.ravel(), stat.ravel()
+    if cluster_stat == 'mass':
+        return np.bincount(flat_labels, weights=flat_stat)[1:]
+    elif cluster_stat == 'size':
+        # all points of a cluster have the same sign, so summing the signs
+        # gives the (signed) size
+        return np.bincount(flat_labels, weights=np.sign(flat_stat))[1:]
+
+    n_labels = flat_labels.max() if flat_labels.size > 0 else 0
+    peaks = np.zeros(n_labels + 1)
+    np.maximum.at(peaks, flat_labels, np.abs(flat_stat))
+    if signs is None:
+        # any point of a cluster gives its sign
+        values = np.zeros(n_labels + 1)
+        values[flat_labels] = flat_stat
+        signs = np.sign(values[1:])
+    return signs * peaks[1:]
+
+
+def _check_cluster_stat(cluster_stat):
+    valid = ['mass', 'size', 'max']
+    if cluster_stat not in valid:
+        raise ValueError('cluster_stat must be one of: {}, got {}.'.format(
+            ', '.join(valid), cluster_stat))
+
+
 # TODO: do not convert to sparse if already sparse
 def cluster_1d(data, connectivity=None):
     from mne.stats.cluster_level import _find_clusters
@@ -239,106 +671,239 @@ def cluster_1d(data, connectivity=None):
     return _find_clusters(data, 0.5, connectivity=connectivity)
 
 
-# TODO: this needs docs!
 def cluster_spread(cluster, connectivity):
+    '''Count cluster points shared by each pair of neighbouring channels.
+
+    Parameters
+    ----------
+    cluster : boolean array
+        Cluster mask with channels as the first dimension.
+    connectivity : boolean array | sparse array
+        Channel adjacency matrix of shape ``(n_channels, n_channels)``.
+
+    Returns
+    -------
+    spread : int array
+        Array of shape ``(n_channels, n_channels)``. ``spread[i, j]`` is the
+        number of points where both channel ``i`` and its neighbour ``j``
+        belong to the cluster (zero for channels that are not neighbours).
+    '''
     n_chan = connectivity.shape[0]
-    spread = np.zeros((n_chan, n_chan), 'int')
-    unrolled = [cluster[ch, :].ravel() for ch in range(n_chan)]
-    for ch in range(n_chan - 1):  # last chan will be already checked
-        ch1 = unrolled[ch]
-
-        # get unchecked neighbours
-        neighbours = np.where(connectivity[ch + 1:, ch])[0]
-        if neighbours.shape[0] > 0:
-            neighbours += ch + 1
-
-            for ngb in neighbours:
-                ch2 = unrolled[ngb]
-                num_connected = (ch1 & ch2).sum()
-                spread[ch, ngb] = num_connected
-                spread[ngb, ch] = num_connected
+    if sparse.issparse(connectivity):
+        connectivity = connectivity.toarray()
+
+    # neighbour pairs are taken from the lower triangle of connectivity
+    adjacency = np.tril(np.asarray(connectivity, dtype=bool), k=-1)
+    adjacency |= adjacency.T
+
+    # number of shared points for all channel pairs is one dense matrix
+    # product, then only neighbouring pairs are kept; float32 counts are
+    # exact below 2 ** 24 points per channel
+    unrolled = cluster.reshape(n_chan, -1)
+    dtype = 'float32' if unrolled.shape[1] < 2 ** 24 else 'float64'
+    unrolled = unrolled.astype(dtype)
+    spread = (unrolled @ unrolled.T).astype('int')
+    spread[~adjacency] = 0
     return spread
 
 
 # - [x] add min_channel_neighbours
-# - [ ] add docs!
 # - [ ] min_neighbours as a 0 - 1 float
 # - [ ] include_channels (what was the idea here?)
-def filter_clusters(mat, min_neighbours=4, min_channels=0, connectivity=None):
-    kernel = np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]])
-    mat = mat.copy()
-    size = mat.shape
+def filter_clusters(mat, min_neighbours=4, min_channels=0, connectivity=None,
+                    backend='numpy'):
+    '''Remove cluster points with too few neighbours.
+
+    All channels are filtered at once: first points with less than
+    ``min_neighbours`` in-cluster neighbours in the two non-channel dimensions
+    (out of 8) are removed. Then, if ``min_channels > 0``, points with less
+    than ``min_channels`` neighbouring channels in the cluster (after the
+    first step) are removed.
+
+    Parameters
+    ----------
+    mat : boolean array
+        Cluster mask of shape ``(n_channels, dim2, dim3)`` or
+        ``(dim2, dim3)``.
+    min_neighbours : int
+        Minimum number of in-cluster neighbours in the non-channel dimensions.
+    min_channels : int
+        Minimum number of neighbouring in-cluster channels.
+    connectivity : boolean array | sparse array
+        Channel adjacency matrix, required when ``min_channels > 0``.
+    backend : str
+        ``'numpy'`` uses one N-d convolution and one sparse product.
+        ``'numba'`` does both steps in one pass over the data.
+
+    Returns
+    -------
+    mat : boolean array
+        Filtered cluster mask of shape ``(n_channels, dim2, dim3)``.
+    '''
+    from scipy import ndimage
+
     if mat.ndim == 2:
         mat = mat[np.newaxis, :, :]
-        size = mat.shape
-
-    for ch in range(size[0]):
-        enough_ngb = (signal.convolve2d(mat[ch, :, :], kernel, mode='same')
-                      >= min_neighbours)
-        mat[ch, :, :] = mat[ch, :, :] & enough_ngb
+    mat = mat.astype('bool')
     if min_channels > 0:
         assert connectivity is not None
-        for ch in range(size[0]):
-            ngb = np.where(connectivity[ch, :])[0]
-            mat[ch, :, :] = mat[ch, :, :] & (mat[ngb, :, :].sum(
-                axis=0) >= min_channels)
+        connectivity = sparse.csr_matrix(connectivity, dtype='bool')
+
+    if backend == 'numba':
+        from .cluster_numba import filter_clusters_3d
+        if min_channels == 0:
+            connectivity = sparse.csr_matrix((mat.shape[0], mat.shape[0]),
+                                             dtype='bool')
+        return filter_clusters_3d(mat, connectivity.indptr,
+                                  connectivity.indices, min_neighbours,
+                                  min_channels)
+
+    kernel = np.array([[[1, 1, 1], [1, 0, 1], [1, 1, 1]]])
+    n_neighbours = ndimage.convolve(mat.astype('int'), kernel,
+                                    mode='constant')
+    mat &= n_neighbours >= min_neighbours
+
+    if min_channels > 0:
+        n_chan = mat.shape[0]
+        n_channels = connectivity.astype('int') @ mat.reshape(n_chan, -1)
+        mat &= n_channels.reshape(mat.shape) >= min_channels
     return mat
 
 
 def remove_links(mat, min_pixels=5):
     '''Remove clusters that are smaller than min_pixels within any given
     slice (channel) of the matrix. These small blobs sometimes create
-    weak links between otherwise strong clusters.'''
-    from skimage.measure import label
-
-    # label each channel separately
-    n_chan = mat.shape[0]
-    mat = mat.copy()
-    for ch in range(n_chan):
-        clusters = label(mat[ch, :, :], connectivity=1, background=False)
-        n_clusters = clusters.max()
-        for c in range(n_clusters):
-            msk = clusters == (c + 1)
-            if (msk).sum() < min_pixels:
-                clusters[msk] = 0
-        mat[ch, clusters == 0] = False
-    return mat
+    weak links between otherwise strong clusters.
+
+    All channels are labeled in one call, with a structuring element that
+    does not connect points across channels. Blob sizes are then counted
+    with ``np.bincount`` and small blobs are removed with a lookup table.'''
+    from scipy import ndimage
+
+    # 4-connectivity within each channel, no connections across channels
+    structure = np.zeros((3, 3, 3), dtype='bool')
+    structure[1] = ndimage.generate_binary_structure(2, 1)
 
+    clusters, _ = ndimage.label(mat, structure=structure)
+    keep = np.bincount(clusters.ravel()) >= min_pixels
+    keep[0] = False
+    return keep[clusters]
 
-def relabel_mat(mat, label_map):
+
+def relabel_mat(mat, label_map, inplace=False):
     '''Change values in a matrix of integers such that mapping given
     in label_map dict is fulfilled.
 
+    The mapping is applied in a single pass over the matrix: with a dense
+    lookup array when the range of labels is not much larger than the matrix
+    and with ``np.searchsorted`` on the sorted map keys otherwise.
+
     parameters
     ----------
     mat - numpy array of integers
     label_map - dictionary, how to remap integer labels
+    inplace - bool, whether to modify mat in place (defaults to False)
 
     returns
     -------
     mat_relab - relabeled numpy array
     '''
-    mat_relab = mat.copy()
-    for k, v in label_map.items():
-        mat_relab[mat == k] = v
-    return mat_relab
-
-
-def smooth(matrix, sd=2.):
-    from scipy.ndimage.filters import gaussian_filter
-    matrix = matrix.copy()
-    if matrix.ndim > 2:
-        n_chan = matrix.shape[0]
-        for ch in range(n_chan):
-            matrix[ch, :] = gaussian_filter(matrix[ch, :], sd)
-    else:
-        matrix = gaussian_filter(matrix, sd)
-    return matrix
+    out = mat if inplace else None
+    if len(label_map) == 0 or mat.size == 0:
+        return mat if inplace else mat.copy()
+
+    keys = np.fromiter(label_map.keys(), dtype=mat.dtype, count=len(label_map))
+    values = np.fromiter(label_map.values(), dtype=mat.dtype,
+                         count=len(label_map))
+
+    # python ints, so that the range of labels does not overflow
+    low = int(min(mat.min(), keys.min()))
+    high = int(max(mat.max(), keys.max()))
+    if high - low < max(mat.size, 2 ** 16):
+        # dense lookup array
+        lookup = np.arange(low, high + 1, dtype=mat.dtype)
+        lookup[keys - low] = values
+        return np.take(lookup, mat - low if low != 0 else mat, out=out)
+
+    # sparse label map
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+    idx = np.searchsorted(keys, mat)
+    idx[idx == len(keys)] = 0
+    found = keys[idx] == mat
+    if out is None:
+        out = mat.copy()
+    out[found] = values[idx[found]]
+    return out
+
+
+def smooth(matrix, sd=2., out=None, dtype=None, n_jobs=1):
+    '''Smooth matrix with gaussian kernel.
+
+    For matrices with more than two dimensions the first dimension is treated
+    as channels and is not smoothed.
+
+    Parameters
+    ----------
+    matrix : numpy array
+        Matrix to smooth.
+    sd : float | list of float
+        Standard deviation of the gaussian kernel. Can be given separately for
+        each smoothed axis, for example ``sd=[1., 3.]`` smooths frequency with
+        ``sd=1.`` and time with ``sd=3.`` for channels x frequency x time
+        matrix. Defaults to ``2.``.
+    out : numpy array | None
+        Array to put the result in. Pass ``out=matrix`` to smooth in place.
+        Defaults to ``None``, which creates a new array.
+    dtype : str | numpy dtype | None
+        Data type to perform the smoothing in, for example ``'float32'``.
+        Defaults to ``None``, which uses the data type of ``matrix``.
+    n_jobs : int
+        Number of threads smoothing separate blocks of channels. Defaults to
+        ``1``.
+
+    Returns
+    -------
+    out : numpy array
+        Smoothed matrix.
+    '''
+    from scipy.ndimage import gaussian_filter
+
+    has_channels = matrix.ndim > 2
+    n_smoothed = matrix.ndim - int(has_channels)
+    sd = np.broadcast_to(np.asarray(sd, dtype='float'), (n_smoothed,))
+    sigma = [0.] * int(has_channels) + sd.tolist()
+
+    if dtype is not None:
+        matrix = matrix.astype(dtype, copy=False)
+    if out is None:
+        out = np.empty(matrix.shape, dtype=matrix.dtype)
+
+    if not has_channels or n_jobs == 1:
+        gaussian_filter(matrix, sigma, output=out)
+        return out
+
+    # scipy.ndimage releases the GIL, so threads are enough
+    from concurrent.futures import ThreadPoolExecutor
+
+    def smooth_block(block):
+        gaussian_filter(matrix[block], sigma, output=out[block])
+
+    limits = np.linspace(0, matrix.shape[0], num=n_jobs + 1).astype('int')
+    blocks = [slice(start, stop) for start, stop in zip(limits[:-1],
+                                                        limits[1:])
+              if stop > start]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(smooth_block, blocks))
+    return out
 
 
 def check_list_inst(data, inst):
     tps = list()
     for this_data in data:
+        if isinstance(this_data, str):
+            # file paths are checked when the objects are read
+            continue
         if not isinstance(this_data, inst):
             raise TypeError('One of the objects in data list does not '
                             'belong to supported mne objects (Evoked, '
@@ -350,6 +915,285 @@ def check_list_inst(data, inst):
                         ' mne object class.')
 
 
+def _null_description(dist):
+    '''Describe the permutation null distribution for Clusters.'''
+    return dict(n_permutations=len(dist['pos']), null_pos=dist['pos'],
+                null_neg=dist['neg'],
+                critical=dist.get('critical', np.array([-np.inf, np.inf])))
+
+
+def _time_freq_slices(inst, tmin=None, tmax=None, fmin=None, fmax=None):
+    '''Find time and frequency slices corresponding to given ranges.'''
+    time_slice, freq_slice = slice(None), slice(None)
+    tfr_types = (mne.time_frequency.AverageTFR, mne.time_frequency.EpochsTFR)
+    if isinstance(inst, (mne.Evoked,) + tfr_types):
+        tmin = 0 if tmin is None else inst.time_as_index(tmin)[0]
+        tmax = (len(inst.times) if tmax is None
+                else inst.time_as_index(tmax)[0] + 1)
+        time_slice = slice(tmin, tmax)
+
+    if isinstance(inst, (borsar.freq.PSD,) + tfr_types):
+        fmin = 0 if fmin is None else find_index(inst.freqs, fmin)
+        fmax = (len(inst.freqs) if fmax is None
+                else find_index(inst.freqs, fmax))
+        freq_slice = slice(fmin, fmax + 1)
+    return time_slice, freq_slice
+
+
+def _range_slice(values, vmin=None, vmax=None):
+    '''Find slice of ``values`` (times or frequencies) from ``vmin`` to
+    ``vmax``.'''
+    start = 0 if vmin is None else find_index(values, vmin)
+    stop = len(values) if vmax is None else find_index(values, vmax) + 1
+    return slice(start, stop)
+
+
+def _slice_trials(data, freq_slice, time_slice, chunk_size=None):
+    '''Select frequency and time range of trial-level array-like data.
+
+    Numpy arrays (also memory-mapped) are sliced without copying. Other
+    array-like data (for example HDF5 datasets) are wrapped in
+    ``_TrialSlice`` and read lazily when ``chunk_size`` is given, or read
+    into memory otherwise.
+    '''
+    if data.ndim != 4:
+        raise ValueError('Trial-level array-like data have to be of shape '
+                         '(n_trials, n_channels, n_freqs, n_times), got '
+                         'array of shape {}.'.format(data.shape))
+    if isinstance(data, np.ndarray):
+        return data[:, :, freq_slice, time_slice]
+    elif chunk_size is None:
+        return np.asarray(data[:, :, freq_slice, time_slice])
+    else:
+        return _TrialSlice(data, freq_slice, time_slice)
+
+
+class _TrialSlice(object):
+    '''Frequency and time range of trial-level data read only when indexed.
+
+    Indexing along the first (trials) dimension reads the selected trials
+    (for example from an HDF5 dataset) already restricted to the frequency
+    and time range.
+    '''
+
+    def __init__(self, data, freq_slice, time_slice):
+        self.data = data
+        self.freq_slice = freq_slice
+        self.time_slice = time_slice
+        n_trials, n_channels, n_freqs, n_times = data.shape
+        self.shape = (n_trials, n_channels,
+                      len(range(*freq_slice.indices(n_freqs))),
+                      len(range(*time_slice.indices(n_times))))
+        self.ndim = 4
+
+    def __getitem__(self, idx):
+        return self.data[idx, :, self.freq_slice, self.time_slice]
+
+
+def _read_inst(inst):
+    '''Read mne object from file if file path was given.'''
+    if not isinstance(inst, str):
+        return inst
+
+    if inst.endswith('.h5'):
+        inst = mne.time_frequency.read_tfrs(inst)
+        # older mne versions return a list of TFRs
+        return inst[0] if isinstance(inst, list) else inst
+    elif inst.endswith(('.fif', '.fif.gz')):
+        return mne.read_evokeds(inst, condition=0, verbose=False)
+    else:
+        raise ValueError('Unsupported file type: {}. Only Evoked (.fif) and '
+                         'TFR (.h5) files can be read.'.format(inst))
+
+
+def _stack_data(data, extract, scratch_dir=None, data2=None):
+    '''Stack data of consecutive objects into one observations x ... array.
+
+    Parameters
+    ----------
+    data : list of mne objects | list of str
+        Objects or paths to object files.
+    extract : callable
+        Function that returns the data array of interest from an object.
+    scratch_dir : str | None
+        Directory for the memory-mapped array. If ``None`` the data are
+        stacked into a regular array.
+    data2 : list of mne objects | list of str | None
+        Objects of the second condition. If given, the differences between
+        the data of consecutive ``data`` and ``data2`` objects are stacked
+        (for paired tests), without stacking each condition first.
+
+    Returns
+    -------
+    stacked : numpy array | numpy memmap
+        Data of all the objects.
+    '''
+    # objects are copied into a preallocated array one by one and released
+    # right after copying (or read from disk only when needed), so the data
+    # of all observations are never held twice in memory
+    data = list(data)
+    data2 = None if data2 is None else list(data2)
+
+    def read_observation(idx):
+        obs = extract(_read_inst(data[idx]))
+        data[idx] = None
+        if data2 is not None:
+            obs = obs - extract(_read_inst(data2[idx]))
+            data2[idx] = None
+        return obs
+
+    first = read_observation(0)
+    shape = (len(data),) + first.shape
+    if scratch_dir is None:
+        stacked = np.empty(shape, dtype=first.dtype)
+    else:
+        import tempfile
+        import weakref
+        os.makedirs(scratch_dir, exist_ok=True)
+        # the file has to be named so that parallel workers can map it too
+        fid, fname = tempfile.mkstemp(dir=scratch_dir, suffix='.dat')
+        os.close(fid)
+        stacked = np.memmap(fname, dtype=first.dtype, mode='w+', shape=shape)
+        # the file is removed as soon as the memmap is released
+        weakref.finalize(stacked, _remove_file, fname)
+
+    stacked[0] = first
+    first = None
+    for idx in range(1, len(data)):
+        stacked[idx] = read_observation(idx)
+    return stacked
+
+
+def _remove_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+
+class LabelClusters(Clusters):
+    '''Clusters storing cluster membership as one integer label array.
+
+    Boolean masks of the clusters (the ``clusters`` attribute) are created
+    from the label array only when accessed, so the object is much smaller in
+    memory and faster to pickle than ``Clusters`` with many clusters. Changing
+    the masks in place does not change the clusters - assign new masks to
+    ``clusters`` instead.
+
+    Parameters
+    ----------
+    stat : ndarray
+        Statistical map of the analysis.
+    labels : ndarray of int | None
+        Cluster labels of the same shape as ``stat``. ``0`` marks points that
+        do not belong to any cluster, cluster ``idx`` (with p value
+        ``pvals[idx]``) is marked with ``idx + 1``. ``None`` if no clusters
+        were found.
+    pvals : list or array of float | None
+        P values of consecutive clusters.
+    **kwargs : additional arguments
+        Other arguments of ``borsar.cluster.Clusters`` (``dimnames``,
+        ``dimcoords``, ``info``, ``description``, etc.).
+    '''
+    def __init__(self, stat, labels=None, pvals=None, dimnames=None,
+                 dimcoords=None, info=None, src=None, subject=None,
+                 subjects_dir=None, description=None, safety_checks=True):
+        super().__init__(stat, None, None, dimnames=dimnames,
+                         dimcoords=dimcoords, info=info, src=src,
+                         subject=subject, subjects_dir=subjects_dir,
+                         description=description, safety_checks=safety_checks)
+
+        if labels is None or pvals is None or len(pvals) == 0:
+            labels, pvals = None, None
+        else:
+            labels = np.asarray(labels).astype('int32', copy=False)
+            pvals = np.asarray(pvals)
+
+        if safety_checks and labels is not None:
+            if not labels.shape == stat.shape:
+                raise ValueError('`labels` has to have the same shape as '
+                                 '`stat`, got {} and {}.'.format(
+                                     labels.shape, stat.shape))
+            if not labels.max() == pvals.shape[0]:
+                raise ValueError('Number of clusters in `labels` does not '
+                                 'match the number of p values.')
+
+            # sort by p values if necessary
+            pval_sort = np.argsort(pvals)
+            if not (pval_sort == np.arange(pvals.shape[0])).all():
+                label_map = np.zeros(pvals.shape[0] + 1, dtype='int32')
+                label_map[pval_sort + 1] = np.arange(1, pvals.shape[0] + 1)
+                labels = np.take(label_map, labels)
+                pvals = pvals[pval_sort]
+
+        self.labels = labels
+        self.pvals = pvals
+        if labels is not None:
+            masses = np.bincount(labels.ravel(), weights=stat.ravel(),
+                                 minlength=pvals.shape[0] + 1)[1:]
+            self.polarity = ['pos' if mass > 0 else 'neg' for mass in masses]
+
+    @property
+    def clusters(self):
+        '''Boolean masks of consecutive clusters, created from labels.'''
+        if self.labels is None:
+            return None
+        cluster_id = np.arange(1, self.labels.max() + 1)
+        cluster_id = cluster_id.reshape((-1,) + (1,) * self.labels.ndim)
+        return self.labels[np.newaxis] == cluster_id
+
+    @clusters.setter
+    def clusters(self, clusters):
+        if clusters is None or len(clusters) == 0:
+            self.labels = None
+            return
+
+        labels = np.zeros(clusters[0].shape, dtype='int32')
+        for idx, clst in enumerate(clusters, start=1):
+            labels[clst] = idx
+        self.labels = labels
+
+    @property
+    def label_pvals(self):
+        '''Cluster label to p value table - ``label_pvals[labels]`` gives the
+        p value of every point (``1.`` outside of clusters).'''
+        if self.labels is None:
+            return np.ones(1)
+        return np.concatenate([[1.], self.pvals])
+
+    def __len__(self):
+        '''Return number of clusters in LabelClusters.'''
+        return len(self.pvals) if self.labels is not None else 0
+
+    def __next__(self):
+        if self._current >= len(self):
+            raise StopIteration
+        clst = Clusters(self.stat, (self.labels == self._current + 1)[None],
+                        self.pvals[[self._current]], self.dimnames,
+                        self.dimcoords, info=self.info, src=self.src,
+                        subject=self.subject, subjects_dir=self.subjects_dir,
+                        description=self.description, safety_checks=False)
+        clst.stc = self.stc
+        clst.polarity = [self.polarity[self._current]]
+        self._current += 1
+        return clst
+
+    def copy(self, deep=True):
+        '''Copy the LabelClusters object (see ``Clusters.copy``).'''
+        if deep:
+            from copy import deepcopy
+            return deepcopy(self)
+
+        clst = LabelClusters(
+            self.stat, self.labels, self.pvals, self.dimnames, self.dimcoords,
+            info=self.info, src=self.src, subject=self.subject,
+            subjects_dir=self.subjects_dir, description=self.description,
+            safety_checks=False)
+        clst.stc = self.stc if self.stc is None else self.stc.copy()
+        clst.polarity = self.polarity
+        return clst
+
+
 # - [ ] add TFR tests!
 # - [ ] make sure min_adj_ch works with 2d
 # - [ ] add Epochs to supported types if single_trial
@@ -359,27 +1203,50 @@ def permutation_cluster_ttest(data1, data2, paired=False, n_permutations=1000,
                               threshold=None, p_threshold=0.05,
                               adjacency=None, tmin=None, tmax=None,
                               fmin=None, fmax=None, trial_level=False,
-                              min_adj_ch=0):
+                              min_adj_ch=0, n_jobs=1, seed=None,
+                              sequential=False, alpha=0.05, checkpoint=None,
+                              scratch_dir=None, chunk_size=None,
+                              cluster_stat='mass', out_type='mask',
+                              batch_memory=256., info=None, freqs=None,
+                              times=None):
     '''Perform cluster-based permutation test with t test as statistic.
 
     Parameters
     ----------
-    data1 : list of mne objects
-        List of objects (Evokeds, TFRs) belonging to condition one.
-    data2 : list of mne objects
-        List of objects (Evokeds, TFRs) belonging to condition two.
+    data1 : list of mne objects | list of str | array-like
+        List of objects (Evokeds, TFRs) belonging to condition one. Can also
+        be a list of file paths to these objects (``.fif`` files for Evokeds
+        and ``.h5`` files for TFRs) - the files are then read one by one, so
+        that all the objects never live in memory at once. Trial-level data
+        (``trial_level=True``) can also be given as an array, memory-mapped
+        array or HDF5 dataset of shape ``(n_trials, n_channels, n_freqs,
+        n_times)`` - ``info``, ``freqs`` and ``times`` have to be given then.
+        HDF5 datasets are read ``chunk_size`` trials at a time, or read into
+        memory whole when ``chunk_size`` is ``None``.
+    data2 : list of mne objects | list of str | array-like | None
+        List of objects (Evokeds, TFRs) belonging to condition two. Can also
+        be a list of file paths or trial-level array-like data (see
+        ``data1``). ``None`` gives one-sample t test.
     paired : bool
         Whether to perform a paired t test. Defaults to ``True``.
     n_permutations : int
         How many permutations to perform. Defaults to ``1000``.
-    threshold : value
+    threshold : value | dict
         Cluster entry threshold defined by the value of the statistic. Defautls
         to ``None`` which calculates threshold from p value (see
-        ``p_threshold``)
+        ``p_threshold``). A dictionary with ``'start'`` and ``'step'`` keys
+        (and optionally ``'e_power'`` and ``'h_power'``) leads to
+        threshold-free cluster enhancement (TFCE). For three-dimensional data
+        TFCE clusters are then formed from points significant at ``alpha``,
+        and the p value of a cluster is the lowest p value of its points.
+        The height of the lowest TFCE slice is ``start`` (as in mne), not
+        ``step`` (see ``sarna.cluster_numba.tfce_3d``).
     p_threshold : value
         Cluster entry threshold defined by the p value.
     adjacency : boolean array | sparse array
-        Information about channel adjacency.
+        Information about channel adjacency. For three-dimensional data this
+        can also be the sparse adjacency of all channel x frequency x time
+        points returned by ``lattice_adjacency``.
     tmin : float
         Start of the time window of interest (in seconds). Defaults to ``None``
         which takes the earliest possible time.
@@ -395,18 +1262,91 @@ def permutation_cluster_ttest(data1, data2, paired=False, n_permutations=1000,
     min_adj_ch: int
         Minimum number of adjacent in-cluster channels to retain a point in
         the cluster.
+    n_jobs : int
+        Number of processes to compute the permutations with. Used only for
+        three-dimensional data. Defaults to ``1``.
+    seed : int | None
+        Seed for the random permutations. The permutations are the same
+        irrespective of ``n_jobs``. Defaults to ``None``, which gives
+        different permutations each time.
+    sequential : bool
+        Whether to stop drawing permutations once the p value of every cluster
+        is decisively below or above ``alpha`` (the 99% binomial confidence
+        interval of each cluster p value does not contain ``alpha``).
+        ``n_permutations`` is then the maximum number of permutations. Used
+        only for three-dimensional data. Defaults to ``False``.
+    alpha : float
+        Significance level used when ``sequential=True``, when TFCE is used
+        and for the critical cluster statistics of three-dimensional data.
+        Defaults to ``0.05``.
+    checkpoint : str | None
+        Path to a checkpoint ``.npz`` file. If given, the permutation
+        distribution is periodically saved to this file and an interrupted
+        analysis is resumed from it. Running a finished analysis again with
+        higher ``n_permutations`` adds only the missing permutations. A
+        checkpoint saved for different data or analysis settings (threshold,
+        adjacency, ``cluster_stat``, ``min_adj_ch`` or design) raises an
+        error. Used only for three-dimensional data. Defaults to ``None``.
+    scratch_dir : str | None
+        Directory where the data of all observations are stacked into a
+        memory-mapped array, so that the stacked data are kept on disk.
+        Without ``chunk_size`` the permutations still read all the data at
+        once, so memory used by the permutations is bounded only when
+        ``chunk_size`` is also given. Used only for averaged (not
+        trial-level) data. Defaults to ``None``, which stacks the data into
+        an array kept in memory.
+    chunk_size : int | None
+        Number of observations read into memory at a time when computing the
+        t values. Together with ``scratch_dir`` this bounds the memory used
+        by the permutations by the chunk size instead of the size of the
+        data. For trial-level data given as ``EpochsTFR`` all epochs are
+        already held in memory by mne, so ``chunk_size`` limits only the
+        temporary arrays of the permutations - to bound memory pass the
+        trials as a memory-mapped array or HDF5 dataset (see ``data1``). Can
+        not be used with trial-level ``paired=True`` data. Used only for
+        three-dimensional data. Defaults to ``None``, which uses all the
+        observations at once.
+    cluster_stat : str
+        Cluster statistic: ``'mass'`` (sum of t values in the cluster),
+        ``'size'`` (number of cluster points) or ``'max'`` (peak t value in the
+        cluster). Only ``'mass'`` can be used for data with fewer than three
+        dimensions. Defaults to ``'mass'``.
+    out_type : str
+        ``'mask'`` returns ``borsar.cluster.Clusters`` with a boolean mask for
+        each cluster. ``'labels'`` returns ``LabelClusters`` with one int32
+        label array and cluster masks created only when accessed. Defaults to
+        ``'mask'``.
+    batch_memory : float
+        Memory (in megabytes) used for the t values of one batch of
+        permutations - the permutations are computed in batches of as many
+        permutations as fit into this budget. Used only for
+        three-dimensional data. Defaults to ``256.``.
+    info : mne.Info | None
+        Channel information of trial-level array-like data (see ``data1``).
+    freqs : array | None
+        Frequencies of trial-level array-like data (see ``data1``).
+    times : array | None
+        Time points of trial-level array-like data (see ``data1``).
 
     Returns
     -------
-    clst : borsar.cluster.Clusters
-        Obtained clusters.
+    clst : borsar.cluster.Clusters | LabelClusters
+        Obtained clusters. For three-dimensional data the number of
+        permutations actually performed is stored in
+        ``clst.description['n_permutations']``, the sorted null distributions
+        of the maximum positive and minimum negative cluster statistic in
+        ``clst.description['null_pos']`` and ``clst.description['null_neg']``
+        and the negative and positive critical cluster statistics for
+        two-tailed ``alpha`` in ``clst.description['critical']``. With TFCE,
+        the TFCE map and point-wise p values are stored in
+        ``clst.description['tfce']`` and ``clst.description['tfce_pvals']``.
     '''
     if data2 is not None:
         one_sample = False
         stat_fun = ttest_rel_no_p if paired else ttest_ind_no_p
     else:
         one_sample = True
-        stat_fun = lambda data: ttest_1samp_no_p(data[0])
+        stat_fun = ttest_1samp_no_p
 
     try:
         kwarg = 'connectivity'
@@ -415,70 +1355,98 @@ def permutation_cluster_ttest(data1, data2, paired=False, n_permutations=1000,
         kwarg = 'adjacency'
         from mne.source_estimate import spatial_tris_adjacency
 
-    inst = data1[0]
-    len1 = len(data1)
-    len2 = len(data2) if data2 is not None else 0
-
-    if paired:
-        assert len1 == len2
-
-    threshold = _compute_threshold([data1, data2], threshold, p_threshold,
-                                   trial_level, paired, one_sample)
-
-    # data1 and data2 have to be Evokeds or TFRs
-    supported_types = (mne.Evoked, borsar.freq.PSD,
-                       mne.time_frequency.AverageTFR,
-                       mne.time_frequency.EpochsTFR)
-    check_list_inst(data1, inst=supported_types)
-    if data2 is not None:
-        check_list_inst(data2, inst=supported_types)
-
-    # find time and frequency ranges
-    # ------------------------------
-    if isinstance(inst, (mne.Evoked, mne.time_frequency.AverageTFR)):
-        tmin = 0 if tmin is None else inst.time_as_index(tmin)[0]
-        tmax = (len(inst.times) if tmax is None
-                else inst.time_as_index(tmax)[0] + 1)
-        time_slice = slice(tmin, tmax)
+    if not isinstance(data1, (list, tuple)):
+        # trial-level arrays, memory-mapped arrays or HDF5 datasets
+        inst = None
+        if not trial_level:
+            raise ValueError('Data given as arrays or HDF5 datasets have to '
+                             'be trial-level, use trial_level=True.')
+        if info is None or freqs is None or times is None:
+            raise ValueError('info, freqs and times have to be given for '
+                             'data passed as arrays or HDF5 datasets.')
+        time_slice = _range_slice(times, tmin, tmax)
+        freq_slice = _range_slice(freqs, fmin, fmax)
+        freqs = np.asarray(freqs)[freq_slice]
+        times = np.asarray(times)[time_slice]
+        data1, data2 = [_slice_trials(dt, freq_slice, time_slice, chunk_size)
+                        if dt is not None else None for dt in [data1, data2]]
+        threshold = _compute_threshold([data1, data2], threshold,
+                                       p_threshold, trial_level, paired,
+                                       one_sample)
+    else:
+        # the first object is needed for channel, time and frequency
+        # information
+        inst = _read_inst(data1[0])
+        data1 = [inst] + list(data1[1:])
+        len1 = len(data1)
+        len2 = len(data2) if data2 is not None else 0
+
+        if paired:
+            assert len1 == len2
+
+        # trial-level data are given as one object per condition
+        threshold_data = ([inst, _read_inst(data2[0]) if data2 is not None
+                           else None] if trial_level else [data1, data2])
+        threshold = _compute_threshold(threshold_data, threshold, p_threshold,
+                                       trial_level, paired, one_sample)
+
+        # data1 and data2 have to be Evokeds or TFRs
+        supported_types = (mne.Evoked, borsar.freq.PSD,
+                           mne.time_frequency.AverageTFR,
+                           mne.time_frequency.EpochsTFR)
+        check_list_inst(data1, inst=supported_types)
+        if data2 is not None:
+            check_list_inst(data2, inst=supported_types)
+
+        # find time and frequency ranges
+        # ------------------------------
+        time_slice, freq_slice = _time_freq_slices(inst, tmin, tmax, fmin,
+                                                   fmax)
+
+        # handle object-specific data
+        # ---------------------------
+        if isinstance(inst, mne.time_frequency.AverageTFR):
+            # + fmin, fmax
+            assert not trial_level
 
-    if isinstance(inst, (borsar.freq.PSD, mne.time_frequency.AverageTFR)):
-        fmin = 0 if fmin is None else find_index(data1[0].freqs, fmin)
-        fmax = (len(inst.freqs) if fmax is None
-                else find_index(data1[0].freqs, fmax))
-        freq_slice = slice(fmin, fmax + 1)
+            # data are in observations x channels x frequencies x time
+            def extract(tfr):
+                return tfr.data[:, freq_slice, time_slice]
+        elif isinstance(inst, mne.time_frequency.EpochsTFR):
+            assert trial_level
+            data1 = inst.data[..., freq_slice, time_slice]
+            data2 = (_read_inst(data2[0]).data[..., freq_slice, time_slice]
+                     if data2 is not None else data2)
+        elif isinstance(inst, borsar.freq.PSD):
+            if not inst._has_epochs:
+                assert not trial_level
 
-    # handle object-specific data
-    # ---------------------------
-    if isinstance(inst, mne.time_frequency.AverageTFR):
-        # + fmin, fmax
-        assert not trial_level
-        # data are in observations x channels x frequencies x time
-        data1 = np.stack([tfr.data[:, freq_slice, time_slice]
-                          for tfr in data1], axis=0)
-        data2 = (np.stack([tfr.data[:, freq_slice, time_slice]
-                           for tfr in data2], axis=0)
-                 if data2 is not None else data2)
-    elif isinstance(inst, mne.time_frequency.EpochsTFR):
-        assert trial_level
-        data1 = inst.data[..., freq_slice, time_slice]
-        data2 = (data2[0].data[..., freq_slice, time_slice]
-                 if data2 is not None else data2)
-    elif isinstance(inst, borsar.freq.PSD):
-        if not inst._has_epochs:
-            assert not trial_level
-            data1 = np.stack([psd.data[:, freq_slice].T for psd in data1],
-                             axis=0)
-            data2 = (np.stack([psd.data[:, freq_slice].T for psd in data2],
-                              axis=0) if data2 is not None else data2)
+                def extract(psd):
+                    return psd.data[:, freq_slice].T
+            else:
+                assert trial_level
+                data1 = data1[0].data[..., freq_slice].transpose((0, 2, 1))
+                data2 = (data2[0].data[..., freq_slice].transpose((0, 2, 1))
+                         if data2 is not None else data2)
         else:
-            assert trial_level
-            data1 = data1[0].data[..., freq_slice].transpose((0, 2, 1))
-            data2 = (data2[0].data[..., freq_slice].transpose((0, 2, 1))
+
+            def extract(erp):
+                return erp.data[:, time_slice].T
+
+        if not trial_level and paired and isinstance(
+                inst, mne.time_frequency.AverageTFR):
+            # paired t test on three-dimensional data is a one-sample t test
+            # on condition differences, these are stacked directly so that
+            # the data of both conditions are never held in memory
+            data1 = _stack_data(data1, extract, scratch_dir=scratch_dir,
+                                data2=data2)
+            data2 = None
+            one_sample, paired = True, False
+        elif not trial_level:
+            # observations are copied one by one into a preallocated array
+            data1 = _stack_data(data1, extract, scratch_dir=scratch_dir)
+            data2 = (_stack_data(data2, extract, scratch_dir=scratch_dir)
                      if data2 is not None else data2)
-    else:
-        data1 = np.stack([erp.data[:, time_slice].T for erp in data1], axis=0)
-        data2 = (np.stack([erp.data[:, time_slice].T for erp in data2], axis=0)
-                 if data2 is not None else data2)
 
     data_3d = data1.ndim > 3
     if (isinstance(adjacency, np.ndarray) and not sparse.issparse(adjacency)
@@ -489,6 +1457,7 @@ def permutation_cluster_ttest(data1, data2, paired=False, n_permutations=1000,
     # --------------------------
     if not data_3d:
         assert min_adj_ch == 0
+        assert cluster_stat == 'mass'
         adj_param = {kwarg: adjacency}
         stat, clusters, cluster_p, _ = permutation_cluster_test(
             [data1, data2], stat_fun=stat_fun, threshold=threshold,
@@ -499,20 +1468,150 @@ def permutation_cluster_ttest(data1, data2, paired=False, n_permutations=1000,
         elif isinstance(inst, borsar.freq.PSD):
             dimcoords = [inst.ch_names, inst.freqs[freq_slice]]
             dimnames = ['chan', 'freq']
+        if out_type == 'labels':
+            labels = np.zeros(stat.T.shape, dtype='int32')
+            for idx, clst in enumerate(clusters, start=1):
+                labels[clst.T] = idx
+            return LabelClusters(stat.T, labels, cluster_p, info=inst.info,
+                                 dimnames=dimnames, dimcoords=dimcoords)
         return Clusters(stat.T, [c.T for c in clusters], cluster_p,
                         info=inst.info, dimnames=dimnames,
                         dimcoords=dimcoords)
 
     else:
-        stat, clusters, cluster_p = _permutation_cluster_test_3d(
-            [data1, data2], adjacency, stat_fun, threshold=threshold,
+        # stat_fun=None uses the default t test with fast sign-flips
+        stat, clusters, cluster_p, dist = _permutation_cluster_test_3d(
+            [data1, data2], adjacency, None, threshold=threshold,
             n_permutations=n_permutations, one_sample=one_sample,
-            paired=paired, min_adj_ch=min_adj_ch)
+            paired=paired, min_adj_ch=min_adj_ch, n_jobs=n_jobs, seed=seed,
+            sequential=sequential, alpha=alpha, checkpoint=checkpoint,
+            chunk_size=chunk_size, cluster_stat=cluster_stat,
+            out_type=out_type, batch_memory=batch_memory,
+            return_distribution=True)
 
         # pack into Clusters object
-        dimcoords = [inst.ch_names, inst.freqs, inst.times[tmin:tmax]]
-        return Clusters(stat, clusters, cluster_p, info=inst.info,
-                        dimnames=['chan', 'freq', 'time'], dimcoords=dimcoords)
+        if inst is not None:
+            info = inst.info
+            freqs, times = inst.freqs[freq_slice], inst.times[time_slice]
+        dimcoords = [info.ch_names, freqs, times]
+        description = _null_description(dist)
+        if 'tfce' in dist:
+            description.update(tfce=dist['tfce'],
+                               tfce_pvals=dist['tfce_pvals'])
+        clusters_class = LabelClusters if out_type == 'labels' else Clusters
+        return clusters_class(stat, clusters, cluster_p, info=info,
+                              dimnames=['chan', 'freq', 'time'],
+                              dimcoords=dimcoords, description=description)
+
+
+def permutation_cluster_ttest_multi(contrasts, n_permutations=1000,
+                                    threshold=None, p_threshold=0.05,
+                                    adjacency=None, tmin=None, tmax=None,
+                                    fmin=None, fmax=None, min_adj_ch=0,
+                                    n_jobs=1, seed=None, cluster_stat='mass',
+                                    out_type='mask', scratch_dir=None,
+                                    alpha=0.05):
+    '''Perform cluster-based permutation t tests of many contrasts at once.
+
+    All the contrasts have to be computed for the same observations (for
+    example the same subjects in the same order). The same sign-flips are
+    used for every contrast, and the t values of all the contrasts are
+    computed in one batched matrix product for each batch of permutations.
+
+    Parameters
+    ----------
+    contrasts : list
+        List of contrasts. Each contrast is either a list of AverageTFR
+        objects (or file paths, see ``permutation_cluster_ttest``) tested
+        against zero with one-sample t test, or a tuple of two such lists
+        compared with paired t test.
+    n_permutations : int
+        How many permutations to perform. Defaults to ``1000``.
+    threshold : value
+        Cluster entry threshold defined by the value of the statistic.
+        Defaults to ``None`` which calculates threshold from p value (see
+        ``p_threshold``).
+    p_threshold : value
+        Cluster entry threshold defined by the p value.
+    adjacency : boolean array | sparse array
+        Information about channel adjacency (see
+        ``permutation_cluster_ttest``).
+    tmin : float
+        Start of the time window of interest (in seconds).
+    tmax : float
+        End of the time window of interest (in seconds).
+    fmin : float
+        Start of the frequency window of interest.
+    fmax : float
+        End of the frequency window of interest.
+    min_adj_ch: int
+        Minimum number of adjacent in-cluster channels to retain a point in
+        the cluster.
+    n_jobs : int
+        Number of processes to compute the permutations with. Defaults to
+        ``1``.
+    seed : int | None
+        Seed for the random permutations. Defaults to ``None``.
+    cluster_stat : str
+        Cluster statistic: ``'mass'``, ``'size'`` or ``'max'`` (see
+        ``permutation_cluster_ttest``). Defaults to ``'mass'``.
+    out_type : str
+        ``'mask'`` returns ``borsar.cluster.Clusters``, ``'labels'`` returns
+        ``LabelClusters``. Defaults to ``'mask'``.
+    scratch_dir : str | None
+        Directory for memory-mapped stacking of the data (see
+        ``permutation_cluster_ttest``). Defaults to ``None``.
+    alpha : float
+        Significance level used for the critical cluster statistics. Defaults
+        to ``0.05``.
+
+    Returns
+    -------
+    clusters : list of borsar.cluster.Clusters | list of LabelClusters
+        Obtained clusters, one object per contrast. The number of
+        permutations, the sorted null distributions and the critical cluster
+        statistics are stored in ``clst.description`` (see
+        ``permutation_cluster_ttest``).
+    '''
+    contrasts = [contrast if isinstance(contrast, tuple) else (contrast,)
+                 for contrast in contrasts]
+    n_obs = [len(data) for contrast in contrasts for data in contrast]
+    if not all(n == n_obs[0] for n in n_obs):
+        raise ValueError('All contrasts have to contain the same number of '
+                         'observations.')
+
+    inst = _read_inst(contrasts[0][0][0])
+    time_slice, freq_slice = _time_freq_slices(inst, tmin, tmax, fmin, fmax)
+
+    def extract(tfr):
+        return tfr.data[:, freq_slice, time_slice]
+
+    # paired contrasts are tested as condition differences
+    data = list()
+    for contrast in contrasts:
+        for this_data in contrast:
+            check_list_inst(this_data, inst=mne.time_frequency.AverageTFR)
+        data2 = contrast[1] if len(contrast) > 1 else None
+        data.append(_stack_data(contrast[0], extract, scratch_dir=scratch_dir,
+                                data2=data2))
+
+    threshold = _compute_threshold([data[0]], threshold, p_threshold, False,
+                                   False, True)
+    stats, clusters, cluster_p, dists = _permutation_cluster_test_3d_multi(
+        data, adjacency, threshold, n_permutations=n_permutations,
+        min_adj_ch=min_adj_ch, n_jobs=n_jobs, seed=seed,
+        cluster_stat=cluster_stat, out_type=out_type, alpha=alpha)
+
+    # pack into Clusters objects
+    clusters_class = LabelClusters if out_type == 'labels' else Clusters
+    dimcoords = [inst.ch_names, inst.freqs[freq_slice],
+                 inst.times[time_slice]]
+    return [clusters_class(stat, clst, pvals, info=inst.info,
+                           dimnames=['chan', 'freq', 'time'],
+                           dimcoords=dimcoords,
+                           description=_null_description(dist))
+            for stat, clst, pvals, dist in zip(stats, clusters, cluster_p,
+                                               dists)]
 
 
 def _permutation_cluster_test_3d(data, adjacency, stat_fun, threshold=None,
@@ -520,115 +1619,995 @@ def _permutation_cluster_test_3d(data, adjacency, stat_fun, threshold=None,
                                  trial_level=False, p_threshold=0.05,
                                  n_permutations=1000, progress=True,
                                  return_distribution=False, backend='auto',
-                                 min_adj_ch=0):
-    """FIXME: add docs."""
+                                 min_adj_ch=0, n_jobs=1, seed=None,
+                                 batch_memory=256., sequential=False,
+                                 alpha=0.05, checkpoint=None,
+                                 chunk_size=None, cluster_stat='mass',
+                                 out_type='mask'):
+    """Perform cluster-based permutation test on three-dimensional data.
+
+    When ``stat_fun`` is ``None`` t test is used. For one-sample and
+    independent samples t test the permutations are then computed in batches
+    - many permutations at once, with at most ``batch_memory`` megabytes used
+    for the statistic of one batch. The data are flattened and the sums (and
+    for independent samples the squared data) are computed only once, before
+    the permutations. Independent samples design is used when both
+    ``one_sample`` and ``paired`` are ``False``.
+
+    With ``sequential=True`` permutations are computed until every cluster p
+    value is decisively below or above ``alpha`` (see ``_sequential_done``),
+    or until ``n_permutations`` is reached.
+
+    When ``checkpoint`` file path is given, the null distribution, the random
+    state and the observed clusters are saved there after every round of
+    permutation blocks. If the file already exists, permutations continue
+    from the saved state.
+
+    If ``threshold`` is a dictionary, TFCE is used instead of a single
+    cluster entry threshold and the null distributions contain maximum and
+    minimum TFCE values.
+
+    ``cluster_stat`` selects the cluster statistic: ``'mass'`` (sum of the
+    statistic in the cluster), ``'size'`` (number of cluster points) or
+    ``'max'`` (peak value of the statistic in the cluster).
+
+    With ``return_distribution=True`` a dictionary is also returned, with the
+    sorted null distributions of the maximum positive (``'pos'``) and
+    minimum negative (``'neg'``) cluster statistics and the critical
+    negative and positive cluster statistics for two-tailed ``alpha``
+    (``'critical'``, see ``_critical_values``).
+
+    With ``out_type='mask'`` clusters are returned as a list of boolean masks.
+    With ``out_type='labels'`` one int32 label array is returned instead,
+    where ``0`` marks points outside clusters and cluster ``idx`` (in the
+    order of the returned p values) is marked with ``idx + 1``.
+
+    When ``chunk_size`` is given, the data arrays (for example memory-mapped
+    arrays or HDF5 datasets) are never read into memory whole. Only
+    ``chunk_size`` observations are read at a time, and the t values of each
+    batch of permutations are computed from sums and sums of squares
+    accumulated over the chunks. The peak memory is then bounded by the chunk
+    and batch sizes instead of the size of the data, at the cost of reading
+    the data once for every batch of permutations. Only the default one-sample
+    and independent samples t tests can be used this way.
+    """
 
     from .utils import progressbar
-    from borsar.cluster.label import _get_cluster_fun, find_clusters
+    from borsar.cluster.label import _get_cluster_fun
     threshold = _compute_threshold(data, threshold, p_threshold, trial_level,
                                    paired, one_sample)
 
-    if not paired and not one_sample or (one_sample and paired):
-        raise ValueError('Currently you have to use either one_sample=True or'
-                         ' paired=True')
+    if one_sample and paired:
+        raise ValueError('You can not use both one_sample=True and '
+                         'paired=True.')
+
+    _check_cluster_stat(cluster_stat)
+    if out_type not in ['mask', 'labels']:
+        raise ValueError("out_type must be 'mask' or 'labels', got {}."
+                         .format(out_type))
+
+    tfce = isinstance(threshold, dict)
+    if tfce and (sequential or min_adj_ch > 0 or cluster_stat != 'mass'):
+        raise ValueError('TFCE can not be used with sequential=True, '
+                         'min_adj_ch > 0 or cluster_stat other than '
+                         '\'mass\'.')
+
+    data = [dt for dt in data if dt is not None]
+    if chunk_size is not None and (stat_fun is not None or paired):
+        raise ValueError('chunk_size can be used only with the default '
+                         'one-sample or independent samples t test.')
+
+    # paired t test is a one-sample t test on condition differences, and
+    # swapping conditions is a sign-flip of the difference - so the
+    # differences are computed once and one-sample sign-flips are used
+    if paired and stat_fun is None:
+        data = [data[0] - data[1]]
+        one_sample, paired = True, False
+
+    # batched permutations can be used only with default t test
+    batched = stat_fun is None and not paired
+    if stat_fun is None:
+        stat_fun = (ttest_1samp_no_p if one_sample else ttest_rel_no_p
+                    if paired else ttest_ind_no_p)
+
+    # test on non-permuted data
+    if chunk_size is None:
+        stat = stat_fun(*data)
+        totals = None
+    else:
+        # sums of all observations are reused by every permutation
+        sums = [_chunked_sums([dt], chunk_size) for dt in data]
+        totals = tuple(np.sum(sm, axis=0) for sm in zip(*sums))
+        n_all = sum(dt.shape[0] for dt in data)
+        if one_sample:
+            stat = ttest_1samp_from_sums(*totals, n_all)
+        else:
+            stat = ttest_ind_from_sums(*sums[0], *totals, data[0].shape[0],
+                                       n_all)
+        stat = stat.reshape(data[0].shape[1:])
+
+    lattice = _is_lattice_adjacency(adjacency, stat)
+    if tfce and lattice:
+        raise ValueError('TFCE can not be used with adjacency of all data '
+                         'points, pass channel adjacency instead.')
+
+    if tfce:
+        # TFCE works on CSR neighbour arrays built once here
+        from .cluster_numba import adjacency_to_csr
+        adjacency = adjacency_to_csr(adjacency)
+        cluster_fun = None
+
+        tfce_stat = _tfce(stat, threshold, adjacency)
+        labels = np.zeros(stat.shape, dtype='int32')
+        cluster_stats = np.zeros(0)
+        found = tfce_stat.any()
+    else:
+        if lattice:
+            # sparse adjacency of all data points is used for the observed
+            # and permuted data
+            cluster_fun = _cluster_lattice
+        else:
+            # use 3d clustering, the clustering function needs dense
+            # channel adjacency
+            if sparse.issparse(adjacency):
+                adjacency = adjacency.toarray()
+            cluster_fun = _get_cluster_fun(stat, adjacency=adjacency,
+                                           backend=backend,
+                                           min_adj_ch=min_adj_ch)
+
+        labels = _label_clusters(stat, threshold, adjacency, cluster_fun,
+                                 min_adj_ch=min_adj_ch)
+        cluster_stats = _cluster_stats(labels, stat, cluster_stat)
+        found = cluster_stats.shape[0] > 0
+
+    if not found:
+        print('No clusters found, permutations are not performed.')
+        clusters = (list() if out_type == 'mask'
+                    else labels.astype('int32', copy=False))
+        if return_distribution:
+            empty = np.zeros(0)
+            return stat, clusters, cluster_stats, dict(pos=empty, neg=empty)
+        return stat, clusters, cluster_stats
+    elif tfce:
+        print('Computing TFCE permutations.')
+    else:
+        msg = 'Found {} clusters, computing permutations.'
+        print(msg.format(cluster_stats.shape[0]))
 
+    # when there are fewer unique sign-flips than permutations, all sign
+    # patterns are enumerated (only half of them, the other half gives the
+    # same statistic with flipped sign)
+    n_obs = data[0].shape[0]
+    sign_flip = one_sample or paired
+    exact = sign_flip and 2 ** (n_obs - 1) <= n_permutations
+    if exact:
+        n_permutations = 2 ** (n_obs - 1)
+        print('Computing exact test with all {} unique sign-flips.'.format(
+            2 * n_permutations))
+
+    # permutations are split into blocks of fixed size, each block has its
+    # own random stream spawned from one SeedSequence - this way the results
+    # do not depend on the number of jobs
+    from mne.parallel import parallel_func
+    pos_dist, neg_dist, done_blocks = list(), list(), list()
+    if checkpoint is not None:
+        fingerprint = _analysis_fingerprint(
+            threshold, adjacency, cluster_stat=cluster_stat,
+            min_adj_ch=min_adj_ch, one_sample=one_sample, paired=paired,
+            exact=exact)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        seed, done_blocks, pos, neg = _read_checkpoint(
+            checkpoint, stat, cluster_stats, fingerprint)
+        pos_dist.append(pos)
+        neg_dist.append(neg)
+
+    n_done = sum(done_blocks)
+    block_sizes = done_blocks + _permutation_blocks(
+        max(n_permutations - n_done, 0))
+    seed_seq = np.random.SeedSequence(seed)
+    if exact:
+        seeds = np.cumsum([0] + block_sizes[:-1]).tolist()
+    else:
+        seeds = seed_seq.spawn(len(block_sizes))
+    parallel, p_fun, n_jobs = parallel_func(_permutation_block, n_jobs)
+
+    if batched:
+        # 3 (sign-flips) or 6 (independent samples) arrays of batch x features
+        # size are allocated when computing t values
+        n_features = stat.size
+        n_arrays = 3 if one_sample else 6
+        batch_size = int(batch_memory * 1e6 // (n_features * 8 * n_arrays))
+        batch_size = max(batch_size, 1)
+    else:
+        batch_size = None
+
+    flat_data, data_sq = None, None
+    if batched and chunk_size is None:
+        # the data are flattened and the sums of squares (which do not
+        # change with permutations) are computed once for all the blocks
+        # (a single array is only reshaped, which does not copy the data)
+        flat_data = (data[0].reshape(data[0].shape[0], -1) if len(data) == 1
+                     else np.concatenate([dt.reshape(dt.shape[0], -1)
+                                          for dt in data], axis=0))
+        if one_sample:
+            # summed observation by observation, so that no squared copy of
+            # all the data is created
+            totals = _chunked_sums([flat_data], 1)
+        else:
+            data_sq = flat_data ** 2
+            totals = (flat_data.sum(axis=0), data_sq.sum(axis=0))
+
+    pbar = progressbar(progress, total=sum(block_sizes))
+    pbar.update(n_done)
+
+    # compute permutations
+    for first in range(len(done_blocks), len(block_sizes), n_jobs):
+        blocks = range(first, min(first + n_jobs, len(block_sizes)))
+        dists = parallel(
+            p_fun(data, seeds[idx], block_sizes[idx], stat_fun, threshold,
+                  adjacency, cluster_fun, one_sample=one_sample,
+                  paired=paired, min_adj_ch=min_adj_ch, batch_size=batch_size,
+                  chunk_size=chunk_size, totals=totals, flat_data=flat_data,
+                  data_sq=data_sq, cluster_stat=cluster_stat)
+            for idx in blocks)
+
+        for pos, neg in dists:
+            pos_dist.append(pos)
+            neg_dist.append(neg)
+            pbar.update(len(pos))
+
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, seed_seq.entropy,
+                             block_sizes[:blocks.stop], pos_dist, neg_dist,
+                             stat, labels, cluster_stats, fingerprint)
+
+        if sequential and _sequential_done(
+                *_full_null(pos_dist, neg_dist, exact=exact),
+                cluster_stats, alpha=alpha):
+            break
+
+    pos_dist, neg_dist = _full_null(pos_dist, neg_dist, exact=exact)
+
+    # the null distributions are sorted once, so that p values (and the
+    # critical values) can be found with binary search
+    pos_dist, neg_dist = np.sort(pos_dist), np.sort(neg_dist)
+
+    # compute permutation probability
+    if tfce:
+        labels, cluster_p, tfce_p = _tfce_clusters(
+            tfce_stat, pos_dist, neg_dist, adjacency, alpha=alpha)
+    else:
+        cluster_p = _cluster_pvals(pos_dist, neg_dist, cluster_stats)
+
+    clusters, cluster_p = _sort_clusters(labels, cluster_p, out_type=out_type)
+
+    if return_distribution:
+        dist = dict(pos=pos_dist, neg=neg_dist,
+                    critical=_critical_values(pos_dist, neg_dist, alpha))
+        if tfce:
+            dist.update(tfce=tfce_stat, tfce_pvals=tfce_p)
+        return stat, clusters, cluster_p, dist
+    else:
+        return stat, clusters, cluster_p
+
+
+def _cluster_pvals(pos_dist, neg_dist, cluster_stats):
+    '''Compute two-tailed cluster p values from sorted null distributions.'''
+    cluster_p = _null_counts(pos_dist, neg_dist, cluster_stats,
+                             is_sorted=True)
+    cluster_p = cluster_p / len(pos_dist)
+    cluster_p *= 2  # because we use two-tail
+    cluster_p[cluster_p > 1.] = 1.  # probability has to be <= 1.
+    return cluster_p
+
+
+def _critical_values(pos_dist, neg_dist, alpha=0.05):
+    '''Find critical negative and positive cluster statistics.
+
+    Clusters with statistic above the positive critical value or below the
+    negative critical value have two-tailed p value lower than ``alpha``.
+    The null distributions have to be sorted.
+
+    Returns
+    -------
+    critical : numpy array
+        Negative and positive critical values. ``[-inf, inf]`` when there are
+        too few permutations to reach ``alpha``.
+    '''
+    n_perm = len(pos_dist)
+    # the largest number of null values at least as extreme as the cluster
+    # statistic that still gives p value lower than alpha
+    n_extreme = int(np.ceil(alpha * n_perm / 2)) - 1
+    if n_perm == 0 or n_extreme < 0:
+        return np.array([-np.inf, np.inf])
+    n_extreme = min(n_extreme, n_perm - 1)
+    return np.array([neg_dist[n_extreme], pos_dist[n_perm - n_extreme - 1]])
+
+
+def _sort_clusters(labels, cluster_p, out_type='mask'):
+    '''Sort clusters by p value and return them as masks or labels.'''
+    cluster_order = np.argsort(cluster_p)
+    cluster_p = cluster_p[cluster_order]
+    n_clusters = cluster_p.shape[0]
+    label_map = np.zeros(n_clusters + 1, dtype='int32')
+    label_map[cluster_order + 1] = np.arange(1, n_clusters + 1)
+    labels = np.take(label_map, labels)
+    if out_type == 'mask':
+        clusters = [labels == idx for idx in range(1, n_clusters + 1)]
+    else:
+        clusters = labels
+    return clusters, cluster_p
+
+
+def _permutation_cluster_test_3d_multi(data, adjacency, threshold,
+                                       n_permutations=1000, progress=True,
+                                       backend='auto', min_adj_ch=0, n_jobs=1,
+                                       seed=None, batch_memory=256.,
+                                       cluster_stat='mass', out_type='mask',
+                                       alpha=0.05):
+    '''One-sample sign-flip cluster-based tests of many contrasts with
+    shared permutations.
+
+    Parameters
+    ----------
+    data : list of numpy arrays
+        Data of consecutive contrasts, each of shape ``(n_observations,
+        n_channels, n_frequencies, n_times)``. The observations have to be
+        the same for all contrasts.
+    threshold : float
+        Cluster entry threshold.
+
+    Other parameters are the same as in ``_permutation_cluster_test_3d``.
+
+    Returns
+    -------
+    stats : list of numpy arrays
+        t values of each contrast.
+    clusters : list
+        Clusters of each contrast, list of boolean masks or label array (see
+        ``out_type`` in ``_permutation_cluster_test_3d``).
+    cluster_p : list of numpy arrays
+        Cluster p values of each contrast.
+    dists : list of dict
+        Sorted null distributions and critical values of each contrast (see
+        ``return_distribution`` in ``_permutation_cluster_test_3d``).
+    '''
+    from .utils import progressbar
+    from borsar.cluster.label import _get_cluster_fun
+
+    _check_cluster_stat(cluster_stat)
+    if isinstance(threshold, dict):
+        raise ValueError('TFCE can not be used when testing many contrasts.')
+
+    n_obs = data[0].shape[0]
+    stat_shape = data[0].shape[1:]
+    stats = [ttest_1samp_no_p(dt) for dt in data]
+
+    # find clusters of each contrast
+    if _is_lattice_adjacency(adjacency, stats[0]):
+        cluster_fun = _cluster_lattice
+    else:
+        if sparse.issparse(adjacency):
+            adjacency = adjacency.toarray()
+        cluster_fun = _get_cluster_fun(stats[0], adjacency=adjacency,
+                                       backend=backend, min_adj_ch=min_adj_ch)
+
+    labels = [_label_clusters(stat, threshold, adjacency, cluster_fun,
+                              min_adj_ch=min_adj_ch) for stat in stats]
+    cluster_stats = [_cluster_stats(lab, stat, cluster_stat)
+                     for lab, stat in zip(labels, stats)]
+    n_clusters = [cl_stats.shape[0] for cl_stats in cluster_stats]
+    print('Found {} clusters, computing permutations.'.format(
+        ', '.join(str(n) for n in n_clusters)))
+
+    exact = 2 ** (n_obs - 1) <= n_permutations
+    if exact:
+        n_permutations = 2 ** (n_obs - 1)
+        print('Computing exact test with all {} unique sign-flips.'.format(
+            2 * n_permutations))
+
+    # contrasts are stacked along the features dimension, so that one matrix
+    # product gives the sums of all the contrasts for a batch of sign-flips
+    flat_data = (data[0].reshape(n_obs, -1) if len(data) == 1 else
+                 np.concatenate([dt.reshape(n_obs, -1) for dt in data],
+                                axis=1))
+    sum_sq = (flat_data ** 2).sum(axis=0)
+    batch_size = int(batch_memory * 1e6 // (flat_data.shape[1] * 8 * 3))
+    batch_size = max(batch_size, 1)
+
+    from mne.parallel import parallel_func
+    block_sizes = _permutation_blocks(n_permutations)
+    if exact:
+        seeds = np.cumsum([0] + block_sizes[:-1]).tolist()
+    else:
+        seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    parallel, p_fun, n_jobs = parallel_func(_permutation_block_multi, n_jobs)
+
+    pbar = progressbar(progress, total=sum(block_sizes))
+    pos_dist, neg_dist = list(), list()
+    for first in range(0, len(block_sizes), n_jobs):
+        blocks = range(first, min(first + n_jobs, len(block_sizes)))
+        dists = parallel(
+            p_fun(flat_data, sum_sq, stat_shape, seeds[idx],
+                  block_sizes[idx], threshold, adjacency, cluster_fun,
+                  min_adj_ch=min_adj_ch, batch_size=batch_size,
+                  cluster_stat=cluster_stat)
+            for idx in blocks)
+
+        for pos, neg in dists:
+            pos_dist.append(pos)
+            neg_dist.append(neg)
+            pbar.update(len(pos))
+
+    # sorted null distributions of shape (n_permutations, n_contrasts)
+    pos_dist, neg_dist = _full_null(pos_dist, neg_dist, exact=exact)
+    pos_dist, neg_dist = np.sort(pos_dist, axis=0), np.sort(neg_dist, axis=0)
+
+    clusters, cluster_p, dists = list(), list(), list()
+    for idx in range(len(data)):
+        pvals = _cluster_pvals(pos_dist[:, idx], neg_dist[:, idx],
+                               cluster_stats[idx])
+        this_clusters, pvals = _sort_clusters(labels[idx], pvals,
+                                              out_type=out_type)
+        clusters.append(this_clusters)
+        cluster_p.append(pvals)
+        dists.append(dict(pos=pos_dist[:, idx], neg=neg_dist[:, idx],
+                          critical=_critical_values(
+                              pos_dist[:, idx], neg_dist[:, idx], alpha)))
+
+    return stats, clusters, cluster_p, dists
+
+
+def _permutation_block_multi(flat_data, sum_sq, stat_shape, seed,
+                             n_permutations, threshold, adjacency,
+                             cluster_fun, min_adj_ch=0, batch_size=100,
+                             cluster_stat='mass'):
+    '''Compute one block of sign-flip permutations for many contrasts.
+
+    Parameters
+    ----------
+    flat_data : numpy array
+        Data of all contrasts of shape ``(n_observations, n_contrasts *
+        n_features)``.
+    sum_sq : numpy array
+        Sum of squares of ``flat_data`` along the observations dimension.
+    stat_shape : tuple of int
+        Shape of the statistical map of one contrast.
+
+    Other parameters are the same as in ``_permutation_block``.
+
+    Returns
+    -------
+    pos_dist : numpy array
+        Maximum positive cluster statistic of shape ``(n_permutations,
+        n_contrasts)``.
+    neg_dist : numpy array
+        Minimum negative cluster statistic of shape ``(n_permutations,
+        n_contrasts)``.
+    '''
+    n_obs = flat_data.shape[0]
+    n_contrasts = flat_data.shape[1] // int(np.prod(stat_shape))
+    if isinstance(seed, np.random.SeedSequence):
+        rng = np.random.default_rng(seed)
+        patterns = None
+    else:
+        rng = None
+        patterns = _sign_patterns(seed, n_permutations, n_obs)
+
+    pos_dist = np.zeros((n_permutations, n_contrasts))
+    neg_dist = np.zeros((n_permutations, n_contrasts))
+    for first in range(0, n_permutations, batch_size):
+        n_batch = min(batch_size, n_permutations - first)
+        perm_signs = _batch_signs(rng, patterns, first, n_batch, n_obs)
+        perm_stats = ttest_1samp_sign_flip_no_p(flat_data, perm_signs,
+                                                sum_sq=sum_sq)
+        perm_stats = perm_stats.reshape((n_batch, n_contrasts) + stat_shape)
+
+        for perm_idx, perm_stat in enumerate(perm_stats):
+            for contrast_idx, contrast_stat in enumerate(perm_stat):
+                (pos_dist[first + perm_idx, contrast_idx],
+                 neg_dist[first + perm_idx, contrast_idx]) = (
+                    _cluster_extremes(contrast_stat, threshold, adjacency,
+                                      cluster_fun, min_adj_ch=min_adj_ch,
+                                      cluster_stat=cluster_stat))
+    return pos_dist, neg_dist
+
+
+def _tfce(stat, threshold, adjacency):
+    '''Compute TFCE map with parameters given in ``threshold`` dictionary.'''
+    from .cluster_numba import tfce_3d
+
+    return tfce_3d(stat, adjacency, start=threshold['start'],
+                   step=threshold['step'],
+                   e_power=threshold.get('e_power', 0.5),
+                   h_power=threshold.get('h_power', 2.))
+
+
+def _tfce_clusters(tfce_stat, pos_dist, neg_dist, adjacency, alpha=0.05):
+    '''Compute point-wise TFCE p values and form clusters of points
+    significant at ``alpha``.
+
+    Returns
+    -------
+    labels : numpy array
+        Cluster labels of significant points, ``0`` marks points outside
+        clusters.
+    cluster_p : numpy array
+        The lowest point-wise p value in each cluster.
+    pvals : numpy array
+        Point-wise p values.
+    '''
+    from .cluster_numba import find_clusters_3d
+
+    # points with zero TFCE get p value of 1
+    pvals = _cluster_pvals(pos_dist, neg_dist, tfce_stat)
+    pos, neg = tfce_stat > 0, tfce_stat < 0
+
+    from scipy import ndimage
+
+    labels = np.zeros(tfce_stat.shape, dtype='int32')
+    cluster_p = list()
+    for sign_mask in [pos, neg]:
+        tail_labels = find_clusters_3d(sign_mask & (pvals < alpha), adjacency)
+        n_tail = tail_labels.max()
+        if n_tail == 0:
+            continue
+        in_cluster = tail_labels > 0
+        labels[in_cluster] = tail_labels[in_cluster] + len(cluster_p)
+        cluster_p.extend(ndimage.minimum(pvals, tail_labels,
+                                         np.arange(1, n_tail + 1)))
+    return labels, np.array(cluster_p), pvals
+
+
+def _save_checkpoint(fname, entropy, block_sizes, pos_dist, neg_dist, stat,
+                     labels, cluster_stats, fingerprint):
+    '''Save permutation state to a checkpoint file.
+
+    The random state is fully described by the entropy of the SeedSequence
+    and the sizes of the permutation blocks that were already computed (each
+    block has its own random stream spawned from this SeedSequence). The
+    analysis settings are saved as ``fingerprint`` (see
+    ``_analysis_fingerprint``).
+    '''
+    # write to a temporary file first so that an interruption during saving
+    # does not corrupt the previous checkpoint
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fid:
+        np.savez(fid, entropy=str(entropy), block_sizes=block_sizes,
+                 pos_dist=np.concatenate(pos_dist),
+                 neg_dist=np.concatenate(neg_dist), stat=stat,
+                 cluster_labels=labels.astype('int32', copy=False),
+                 cluster_stats=cluster_stats, fingerprint=fingerprint)
+    os.replace(tmp_fname, fname)
+
+
+def _read_checkpoint(fname, stat, cluster_stats, fingerprint):
+    '''Read permutation state from a checkpoint file.
+
+    Raises ValueError if the checkpoint was saved for different data (the
+    observed statistic or cluster statistics differ) or for different
+    analysis settings (the fingerprint differs).
+    '''
+    with np.load(fname) as chkp:
+        same = ('fingerprint' in chkp.files
+                and str(chkp['fingerprint']) == fingerprint
+                and chkp['stat'].shape == stat.shape
+                and np.allclose(chkp['stat'], stat)
+                and chkp['cluster_stats'].shape == cluster_stats.shape
+                and np.allclose(chkp['cluster_stats'], cluster_stats))
+        if not same:
+            raise ValueError('The checkpoint file {} was saved for a '
+                             'different analysis.'.format(fname))
+        entropy = int(chkp['entropy'])
+        block_sizes = chkp['block_sizes'].tolist()
+        pos_dist = chkp['pos_dist']
+        neg_dist = chkp['neg_dist']
+    return entropy, block_sizes, pos_dist, neg_dist
+
+
+def _analysis_fingerprint(threshold, adjacency, cluster_stat='mass',
+                          min_adj_ch=0, one_sample=False, paired=False,
+                          exact=False):
+    '''Hash the settings that shape the null distribution.
+
+    The hash covers the cluster entry threshold (or TFCE parameters), the
+    cluster statistic, ``min_adj_ch``, the adjacency and the design of the
+    test. It is used to check that a checkpoint is resumed with the same
+    settings.
+    '''
+    if isinstance(threshold, dict):
+        threshold = sorted((key, float(val)) for key, val in threshold.items())
+    else:
+        threshold = float(threshold)
+    settings = repr((threshold, cluster_stat, int(min_adj_ch),
+                     bool(one_sample), bool(paired), bool(exact)))
+
+    hsh = hashlib.sha1(settings.encode())
+    if adjacency is None:
+        arrays = ()
+    elif isinstance(adjacency, tuple):
+        # CSR neighbour arrays used with TFCE
+        arrays = adjacency
+    elif sparse.issparse(adjacency):
+        adjacency = sparse.csr_matrix(adjacency, dtype='bool')
+        adjacency.sort_indices()
+        arrays = (adjacency.shape, adjacency.indptr, adjacency.indices)
+    else:
+        arrays = (np.shape(adjacency), np.asarray(adjacency, dtype='bool'))
+
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        hsh.update(str(arr.shape).encode())
+        hsh.update(arr.tobytes())
+    return hsh.hexdigest()
+
+
+def _sequential_done(pos_dist, neg_dist, cluster_stats, alpha=0.05,
+                     ci=0.99):
+    '''Check whether all cluster p values are decisively below or above alpha.
+
+    For each cluster the number of permutations exceeding the cluster
+    statistic is binomial. The Clopper-Pearson ``ci`` confidence interval of
+    the (two-tailed) cluster p value is computed from this count and the
+    decision is considered final when the interval does not contain
+    ``alpha``.
+    '''
+    from scipy.stats import beta
+
+    n_perm = len(pos_dist)
+    n_exceed = _null_counts(pos_dist, neg_dist, cluster_stats)
+
+    tail = (1 - ci) / 2
+    lower = np.where(n_exceed > 0,
+                     beta.ppf(tail, n_exceed, n_perm - n_exceed + 1), 0.)
+    upper = np.where(n_exceed < n_perm,
+                     beta.ppf(1 - tail, n_exceed + 1, n_perm - n_exceed), 1.)
+
+    # two-tailed p values
+    decided = (2 * upper < alpha) | (2 * lower > alpha)
+    return decided.all()
+
+
+def _null_counts(pos_dist, neg_dist, cluster_stats, is_sorted=False):
+    '''Count null distribution values at least as extreme as each cluster
+    statistic.
+
+    The counts are found with binary search in the sorted null distributions
+    (``is_sorted=True`` means that ``pos_dist`` and ``neg_dist`` are already
+    sorted). A small relative tolerance is used, so that rounding differences
+    between the observed and permuted statistics do not matter (for example
+    when the observed sign pattern is part of an exact test).
+    '''
+    if not is_sorted:
+        pos_dist, neg_dist = np.sort(pos_dist), np.sort(neg_dist)
+
+    cluster_stats = np.asarray(cluster_stats)
+    tol = _TOLERANCE * np.abs(cluster_stats)
+    pos = cluster_stats > 0
+    counts = np.empty(cluster_stats.shape, dtype='int')
+    counts[pos] = len(pos_dist) - np.searchsorted(
+        pos_dist, (cluster_stats - tol)[pos], 'left')
+    counts[~pos] = np.searchsorted(neg_dist, (cluster_stats + tol)[~pos],
+                                   'right')
+    return counts
+
+
+def _full_null(pos_dist, neg_dist, exact=False):
+    '''Concatenate null distribution blocks.
+
+    For exact test only half of the sign patterns is computed. Flipping all
+    signs of a pattern flips the sign of the statistic, so the other half of
+    the null distribution is obtained by swapping and negating the extremes.
+    '''
+    pos_dist, neg_dist = np.concatenate(pos_dist), np.concatenate(neg_dist)
+    if exact:
+        pos_dist, neg_dist = (np.concatenate([pos_dist, -neg_dist]),
+                              np.concatenate([neg_dist, -pos_dist]))
+    return pos_dist, neg_dist
+
+
+def _sign_patterns(first, n_patterns, n_obs):
+    '''Enumerate sign-flip patterns for exact test.
+
+    Pattern ``k`` has signs of observations ``1, 2, ...`` given by the
+    consecutive bits of ``k``, while the first observation always keeps its
+    sign. This way the ``2 ** (n_obs - 1)`` patterns cover all sign-flips up
+    to the sign of the whole pattern.
+
+    Returns
+    -------
+    patterns : numpy array
+        Array of shape ``(n_patterns, n_obs)`` with ``-1`` and ``1`` values.
+    '''
+    codes = np.arange(first, first + n_patterns)[:, np.newaxis]
+    bits = (codes >> np.arange(n_obs - 1)) & 1
+    patterns = np.ones((n_patterns, n_obs), dtype='int')
+    patterns[:, 1:] = 1 - 2 * bits
+    return patterns
+
+
+def _batch_signs(rng, patterns, first, n_batch, n_obs):
+    '''Draw random sign-flips for a batch of permutations or take them from
+    the enumerated sign patterns (exact test, when ``patterns`` is given).'''
+    if patterns is None:
+        perm_signs = rng.integers(0, 2, size=(n_batch, n_obs))
+        return perm_signs * 2 - 1
+    return patterns[first:first + n_batch]
+
+
+def _permutation_blocks(n_permutations, block_size=100):
+    '''Split permutations into blocks of ``block_size`` permutations.'''
+    n_full, rest = divmod(n_permutations, block_size)
+    block_sizes = [block_size] * n_full
+    if rest > 0:
+        block_sizes.append(rest)
+    return block_sizes
+
+
+def _permutation_block(data, seed, n_permutations, stat_fun, threshold,
+                       adjacency, cluster_fun, one_sample=False, paired=False,
+                       min_adj_ch=0, batch_size=None, chunk_size=None,
+                       totals=None, flat_data=None, data_sq=None,
+                       cluster_stat='mass'):
+    '''Compute one block of permutations.
+
+    Parameters
+    ----------
+    data : list of numpy arrays
+        Data for each condition, observations are in the first dimension.
+    seed : numpy.random.SeedSequence | int
+        Seed sequence used to create the random stream of this block. For
+        exact test this is the index of the first sign pattern of the block
+        (see ``_sign_patterns``).
+    n_permutations : int
+        Number of permutations to compute.
+    batch_size : int | None
+        If not ``None`` one-sample or independent samples t values are
+        computed for ``batch_size`` permutations at once, without creating the
+        permuted data.
+    chunk_size : int | None
+        If not ``None`` the data are read ``chunk_size`` observations at a
+        time (see ``_chunked_sums``). Used only with ``batch_size``.
+    totals : tuple of numpy arrays | None
+        Sums and sums of squares of all observations. Required when
+        ``batch_size`` is not ``None``.
+    flat_data : numpy array | None
+        Data of all conditions flattened to shape ``(n_observations,
+        n_features)`` and stacked along the observations. Required when
+        ``batch_size`` is not ``None`` and ``chunk_size`` is ``None``.
+    data_sq : numpy array | None
+        Squared ``flat_data``. Required for independent samples when
+        ``flat_data`` is given.
+    cluster_stat : str
+        Cluster statistic: ``'mass'``, ``'size'`` or ``'max'`` (see
+        ``_cluster_stats``).
+
+    Returns
+    -------
+    pos_dist : numpy array
+        Maximum positive cluster statistic for each permutation.
+    neg_dist : numpy array
+        Minimum negative cluster statistic for each permutation.
+    '''
     n_obs = data[0].shape[0]
     signs_size = tuple([n_obs] + [1] * (data[0].ndim - 1))
     if one_sample:
         signs = np.array([-1, 1])
 
+    if isinstance(seed, np.random.SeedSequence):
+        rng = np.random.default_rng(seed)
+        patterns = None
+    else:
+        # exact test - seed is the index of the first sign pattern
+        rng = None
+        patterns = _sign_patterns(seed, n_permutations, n_obs)
+
     pos_dist = np.zeros(n_permutations)
     neg_dist = np.zeros(n_permutations)
 
-    # test on non-permuted data
-    stat = stat_fun(*data)
-
-    # use 3d clustering
-    cluster_fun = _get_cluster_fun(stat, adjacency=adjacency,
-                                   backend=backend, min_adj_ch=min_adj_ch)
+    if batch_size is not None:
+        stat_shape = data[0].shape[1:]
+        n_all = sum(dt.shape[0] for dt in data)
+        all_idx = np.arange(n_all)
+
+        for first in range(0, n_permutations, batch_size):
+            n_batch = min(batch_size, n_permutations - first)
+            if not one_sample:
+                # permute group labels - first n_obs indices of each row
+                # form the first group
+                group1 = rng.permuted(np.tile(all_idx, (n_batch, 1)),
+                                      axis=1)[:, :n_obs]
+                if chunk_size is None:
+                    perm_stats = ttest_ind_permuted_no_p(
+                        flat_data, group1, data_sq=data_sq, totals=totals)
+                else:
+                    member = np.zeros((n_batch, n_all))
+                    member[np.arange(n_batch)[:, np.newaxis], group1] = 1.
+                    sum1, sum_sq1 = _chunked_sums(data, chunk_size,
+                                                  weights=member)
+                    perm_stats = ttest_ind_from_sums(sum1, sum_sq1, *totals,
+                                                     n_obs, n_all)
+            else:
+                perm_signs = _batch_signs(rng, patterns, first, n_batch, n_obs)
+                if chunk_size is None:
+                    perm_stats = ttest_1samp_sign_flip_no_p(
+                        flat_data, perm_signs, sum_sq=totals[1])
+                else:
+                    # sums of squares do not change with sign-flips
+                    sums, _ = _chunked_sums(data, chunk_size,
+                                            weights=perm_signs, squares=False)
+                    perm_stats = ttest_1samp_from_sums(sums, totals[1], n_obs)
 
-    clusters, cluster_stats = find_clusters(
-        stat, threshold, adjacency=adjacency, cluster_fun=cluster_fun,
-        min_adj_ch=min_adj_ch)
+            for idx, perm_stat in enumerate(perm_stats):
+                perm_stat = perm_stat.reshape(stat_shape)
+                pos_dist[first + idx], neg_dist[first + idx] = (
+                    _cluster_extremes(perm_stat, threshold, adjacency,
+                                      cluster_fun, min_adj_ch=min_adj_ch,
+                                      cluster_stat=cluster_stat))
 
-    if not clusters:
-        print('No clusters found, permutations are not performed.')
-        return stat, clusters, cluster_stats
-    else:
-        msg = 'Found {} clusters, computing permutations.'
-        print(msg.format(len(clusters)))
+        return pos_dist, neg_dist
 
-    # FIXME - use sarna progressbar
-    pbar = progressbar(progress, total=n_permutations)
+    sign_flip = one_sample or paired
+    if not sign_flip:
+        all_data = np.concatenate(data, axis=0)
 
-    # compute permutations
     for perm in range(n_permutations):
+        if sign_flip and patterns is None:
+            idx = rng.integers(0, 2, size=signs_size)
+        elif sign_flip:
+            idx = ((patterns[perm] + 1) // 2).reshape(signs_size)
+
         # permute data / predictors
         if one_sample:
             # one-sample sign-flip
-            idx = np.random.random_integers(0, 1, size=signs_size)
             perm_signs = signs[idx]
             perm_data = [data[0] * perm_signs]
         elif paired:
-            # this is analogous to one-sample sign-flip but with paired data
-            # (we could also perform one sample t test on condition differences
-            #  with sign-flip in the permutation step)
-            idx1 = np.random.random_integers(0, 1, size=signs_size)
+            # swap conditions within pairs - this branch is reached only with
+            # custom stat_fun, the default t test is run as one-sample
+            # sign-flips of condition differences
+            idx1 = idx
             idx2 = 1 - idx1
             perm_data = list()
             perm_data.append(data[0] * idx1 + data[1] * idx2)
             perm_data.append(data[0] * idx2 + data[1] * idx1)
+        else:
+            # independent samples - shuffle group labels
+            order = rng.permutation(all_data.shape[0])
+            perm_data = [all_data[order[:n_obs]], all_data[order[n_obs:]]]
         perm_stat = stat_fun(*perm_data)
+        pos_dist[perm], neg_dist[perm] = _cluster_extremes(
+            perm_stat, threshold, adjacency, cluster_fun,
+            min_adj_ch=min_adj_ch, cluster_stat=cluster_stat)
 
-        perm_clusters, perm_cluster_stats = find_clusters(
-            perm_stat, threshold, adjacency=adjacency, cluster_fun=cluster_fun,
-            min_adj_ch=min_adj_ch)
+    return pos_dist, neg_dist
 
-        # if any clusters were found - add max statistic
-        if len(perm_cluster_stats) > 0:
-            max_val = perm_cluster_stats.max()
-            min_val = perm_cluster_stats.min()
 
-            if max_val > 0:
-                pos_dist[perm] = max_val
-            if min_val < 0:
-                neg_dist[perm] = min_val
+def _chunked_sums(data, chunk_size, weights=None, squares=True):
+    '''Compute sums and sums of squares of observations chunk by chunk.
 
-        if progressbar:
-            pbar.update(1)
+    Parameters
+    ----------
+    data : list of array-like
+        Data of consecutive conditions (numpy arrays, memory-mapped arrays or
+        HDF5 datasets), observations are in the first dimension. The
+        observations of all conditions are treated as one sequence.
+    chunk_size : int
+        Number of observations read into memory at a time.
+    weights : numpy array | None
+        Weights of shape ``(n_sums, n_observations)``, for example sign-flips
+        or group membership for many permutations. If ``None`` the
+        observations are simply summed.
+    squares : bool
+        Whether to compute the sums of squares. Defaults to ``True``.
 
-    # compute permutation probability
-    cluster_p = np.array([(pos_dist > cluster_stat).mean() if cluster_stat > 0
-                          else (neg_dist < cluster_stat).mean()
-                          for cluster_stat in cluster_stats])
-    cluster_p *= 2  # because we use two-tail
-    cluster_p[cluster_p > 1.] = 1.  # probability has to be <= 1.
+    Returns
+    -------
+    sums : numpy array
+        Sums of shape ``(n_features,)`` or ``(n_sums, n_features)`` when
+        ``weights`` are given.
+    sum_sq : numpy array | None
+        Sums of squares of the same shape as ``sums`` or ``None`` when
+        ``squares=False``.
+    '''
+    sums, sum_sq, start = 0., 0. if squares else None, 0
+    for dt in data:
+        n_obs = dt.shape[0]
+        for first in range(0, n_obs, chunk_size):
+            # copy, so that squaring in place does not modify the data
+            chunk = np.array(dt[first:first + chunk_size], dtype='float64')
+            chunk = chunk.reshape(chunk.shape[0], -1)
+            if weights is None:
+                sums = sums + chunk.sum(axis=0)
+            else:
+                this_weights = weights[:, start + first:
+                                       start + first + chunk.shape[0]]
+                sums = sums + this_weights @ chunk
+            if squares:
+                chunk **= 2
+                sum_sq = sum_sq + (chunk.sum(axis=0) if weights is None
+                                   else this_weights @ chunk)
+        start += n_obs
+    return sums, sum_sq
 
-    # sort clusters by p value
-    cluster_order = np.argsort(cluster_p)
-    cluster_p = cluster_p[cluster_order]
-    clusters = [clusters[i] for i in cluster_order]
 
-    if return_distribution:
-        return stat, clusters, cluster_p, dict(pos=pos_dist, neg=neg_dist)
-    else:
-        return stat, clusters, cluster_p
+def _cluster_extremes(stat, threshold, adjacency, cluster_fun, min_adj_ch=0,
+                      cluster_stat='mass'):
+    '''Find the extreme positive and negative cluster statistics.
+
+    Only the cluster label array is created for each tail, the cluster
+    statistics are computed from it in one pass (see ``_cluster_stats``), so
+    no cluster masks or lists are built.
+
+    Parameters
+    ----------
+    stat : numpy array
+        Statistical map.
+    threshold : float | dict
+        Cluster entry threshold. ``-threshold`` is used for negative clusters.
+        If dict - TFCE parameters, the extreme TFCE values are returned then.
+    adjacency : numpy array | sparse matrix | tuple of numpy arrays | None
+        Dense channel adjacency matrix, sparse adjacency of all data points
+        (see ``lattice_adjacency``) or CSR neighbour arrays (for TFCE).
+    cluster_fun : callable
+        Clustering function returning cluster labels for a boolean mask.
+    min_adj_ch : int
+        Minimum number of adjacent in-cluster channels to retain a point in
+        the cluster.
+    cluster_stat : str
+        Cluster statistic: ``'mass'``, ``'size'`` or ``'max'``.
+
+    Returns
+    -------
+    max_val : float
+        Maximum positive cluster statistic, ``0.`` if there are no positive
+        clusters.
+    min_val : float
+        Minimum negative cluster statistic, ``0.`` if there are no negative
+        clusters.
+    '''
+    if isinstance(threshold, dict):
+        tfce_stat = _tfce(stat, threshold, adjacency)
+        return [max(tfce_stat.max(), 0.), min(tfce_stat.min(), 0.)]
+
+    extremes = [0., 0.]
+    for idx, mask in enumerate([stat > threshold, stat < -threshold]):
+        if not mask.any():
+            continue
+
+        labels = cluster_fun(mask, adjacency=adjacency, min_adj_ch=min_adj_ch)
+        cluster_stats = _cluster_stats(labels, stat, cluster_stat)
+        if cluster_stats.shape[0] > 0:
+            extremes[idx] = (max(cluster_stats.max(), 0.) if idx == 0
+                             else min(cluster_stats.min(), 0.))
+    return extremes
 
 
 def _compute_threshold(data, threshold, p_threshold, trial_level, paired,
                        one_sample):
     if threshold is None:
         from scipy.stats import distributions
-        len1 = len(data[0])
-        len2 = len(data[1]) if (len(data) > 1 and data[1] is not None) else 0
+        data2 = data[1] if len(data) > 1 else None
         if trial_level:
-            # or maybe just use len()
-            if hasattr(data[0], 'data'):
-                df = data[0].data.shape[0] + data[1].data.shape[0] - 2
-            else:
-                df = data[0]._data.shape[0] + data[1]._data.shape[0] - 2
+            # observations are trials of mne objects or rows of arrays,
+            # memory-mapped arrays or HDF5 datasets
+            len1, len2 = _n_trials(data[0]), _n_trials(data2)
         else:
-            df = (len1 - 1 if paired or one_sample else
-                  len1 + len2 - 2)
+            len1 = len(data[0])
+            len2 = len(data2) if data2 is not None else 0
+        df = (len1 - 1 if paired or one_sample else
+              len1 + len2 - 2)
         threshold = np.abs(distributions.t.ppf(p_threshold / 2., df=df))
     return threshold
+
+
+def _n_trials(data):
+    '''Number of trials in trial-level data (``0`` for ``None``).'''
+    if data is None:
+        return 0
+    elif hasattr(data, 'shape'):
+        return data.shape[0]
+    elif hasattr(data, 'data'):
+        return data.data.shape[0]
+    else:
+        return data._data.shape[0]
@@ -2,182 +2,457 @@ import numpy as np
 from numba import jit
 
 
-def find_clusters_3d(data, adj):
-    ch, d1, d2 = data.shape
-    neighbours = find_neighbours_numba(adj)
-    clusters = np.zeros((ch, d1, d2), dtype='int64')
-    clusters = _find_clusters_3d_numba(data, clusters, neighbours)
+# kernels are compiled eagerly for the signatures below (arrays are
+# C-contiguous) and cached on disk, so that they are compiled only once and
+# not at every interpreter start
+_csr = 'int32[::1], int32[::1]'
+_find_clusters_sig = ('Tuple((int64[:, :, ::1], float64[::1]))'
+                      '(boolean[:, :, ::1], {}, float64[:, :, ::1])'
+                      .format(_csr))
+_tfce_sig = ('float64[:, :, ::1](float64[:, :, ::1], {}, float64[::1], '
+             'float64, float64)'.format(_csr))
+_tfce_union_sig = ('int64(int64, int64, int64[::1], int64[::1], float64[::1], '
+                   'boolean[::1], int64[::1], int64[::1], int64[::1], int64)')
+_filter_sig = ('boolean[:, :, ::1](boolean[:, :, ::1], {}, int64, int64)'
+               .format(_csr))
+
+
+def adjacency_to_csr(adj):
+    '''Turn channel adjacency into compact CSR neighbour arrays.
+
+    The CSR arrays can be built once and then passed to all numba clustering
+    functions instead of the adjacency matrix.
+
+    Parameters
+    ----------
+    adj : numpy array | scipy sparse matrix
+        Boolean channel adjacency matrix of shape
+        ``(n_channels, n_channels)``.
+
+    Returns
+    -------
+    indptr : numpy array
+        int32 array of length ``n_channels + 1``. Neighbours of channel ``ch``
+        are ``indices[indptr[ch]:indptr[ch + 1]]``.
+    indices : numpy array
+        int32 array of sorted neighbour indices.
+    '''
+    from scipy import sparse
+
+    adj = sparse.csr_matrix(adj, dtype=bool)
+    adj.setdiag(False)
+    adj.eliminate_zeros()
+    adj.sort_indices()
+    return adj.indptr.astype(np.int32), adj.indices.astype(np.int32)
+
+
+def _check_csr(adj):
+    '''Return CSR neighbour arrays, building them only when necessary.'''
+    if isinstance(adj, tuple):
+        return tuple(np.ascontiguousarray(arr, dtype=np.int32) for arr in adj)
+    return adjacency_to_csr(adj)
+
+
+def find_clusters_3d(data, adj, stat=None):
+    '''Find clusters in three-dimensional boolean data.
+
+    Voxels are connected with their lattice neighbours along the last two
+    dimensions and with voxels of adjacent channels (as defined by ``adj``)
+    along the first dimension.
+
+    Parameters
+    ----------
+    data : numpy array
+        Boolean array of shape ``(n_channels, dim2, dim3)``.
+    adj : numpy array | scipy sparse matrix | tuple of numpy arrays
+        Boolean channel adjacency matrix of shape
+        ``(n_channels, n_channels)`` or ``(indptr, indices)`` CSR neighbour
+        arrays returned by ``adjacency_to_csr``.
+    stat : numpy array | None
+        Statistical map of the same shape as ``data``. If given, the sum of
+        ``stat`` within each cluster is returned as well.
+
+    Returns
+    -------
+    clusters : numpy array
+        Integer array of cluster labels. ``0`` marks voxels that do not belong
+        to any cluster, clusters are labeled with consecutive integers starting
+        from ``1``.
+    cluster_stats : numpy array
+        Sum of ``stat`` in each cluster. Returned only if ``stat`` was given.
+    '''
+    data = np.ascontiguousarray(data, dtype=np.bool_)
+    indptr, indices = _check_csr(adj)
+    has_stat = stat is not None
+    if not has_stat:
+        stat = np.zeros(data.shape)
+    stat = np.ascontiguousarray(stat, dtype=np.float64)
+
+    clusters, cluster_stats = _find_clusters_3d_numba(data, indptr, indices,
+                                                      stat)
+    if has_stat:
+        return clusters, cluster_stats
     return clusters
 
 
-@jit(nopython=True)
-def _find_clusters_3d_numba(data, clusters, neighbours):
-    current_cluster = 0
+@jit('int64(int64[::1], int64)', nopython=True, cache=True)
+def _find_root(parents, label):
+    '''Find root of the label's tree, compressing the path on the way.'''
+    root = label
+    while parents[root] != root:
+        root = parents[root]
+    while parents[label] != root:
+        next_label = parents[label]
+        parents[label] = root
+        label = next_label
+    return root
+
+
+@jit('int64(int64[::1], int64, int64)', nopython=True, cache=True)
+def _merge_label(parents, label, ngb_label):
+    '''Join the trees of ``label`` and ``ngb_label``, return the root.'''
+    if ngb_label == 0:
+        return label
+    ngb_root = _find_root(parents, ngb_label)
+    if label == 0:
+        return ngb_root
+
+    root = _find_root(parents, label)
+    if root < ngb_root:
+        parents[ngb_root] = root
+        return root
+    parents[root] = ngb_root
+    return ngb_root
+
+
+@jit(_find_clusters_sig, nopython=True, cache=True)
+def _find_clusters_3d_numba(data, indptr, indices, stat):
     ch, d1, d2 = data.shape
+    clusters = np.zeros((ch, d1, d2), dtype=np.int64)
+
+    # first pass - provisional labels, equivalences are tracked in the
+    # union-find forest (label 0 is background and is never used)
+    parents = np.zeros(data.size + 1, dtype=np.int64)
+    current_cluster = 0
 
     for dim in range(ch):
         for idx1 in range(d1):
             for idx2 in range(d2):
-                if data[dim, idx1, idx2]:
-                    ngb_clusters = _check_neighbours_numba(
-                        clusters, neighbours, dim, idx1, idx2)
-                    if len(ngb_clusters) > 0:
-                        clusters[dim, idx1, idx2] = ngb_clusters[0]
-                    else:
-                        current_cluster += 1
-                        clusters[dim, idx1, idx2] = current_cluster
+                if not data[dim, idx1, idx2]:
+                    continue
+
+                label = 0
+                # idx1 layer
+                if idx1 > 0:
+                    label = _merge_label(parents, label,
+                                         clusters[dim, idx1 - 1, idx2])
+                # idx2 layer
+                if idx2 > 0:
+                    label = _merge_label(parents, label,
+                                         clusters[dim, idx1, idx2 - 1])
+                # adjacency-defined layer (only already visited channels,
+                # neighbour indices are sorted)
+                for ngb_idx in range(indptr[dim], indptr[dim + 1]):
+                    ngb = indices[ngb_idx]
+                    if ngb >= dim:
+                        break
+                    label = _merge_label(parents, label,
+                                         clusters[ngb, idx1, idx2])
+
+                if label == 0:
+                    current_cluster += 1
+                    parents[current_cluster] = current_cluster
+                    label = current_cluster
+                clusters[dim, idx1, idx2] = label
+
+    # second pass - resolve provisional labels to consecutive final labels
+    # and sum the statistic in each cluster
+    final = np.zeros(current_cluster + 1, dtype=np.int64)
+    n_clusters = 0
+    for label in range(1, current_cluster + 1):
+        root = _find_root(parents, label)
+        if root == label:
+            n_clusters += 1
+            final[label] = n_clusters
+    for label in range(1, current_cluster + 1):
+        final[label] = final[_find_root(parents, label)]
+
+    cluster_stats = np.zeros(n_clusters, dtype=np.float64)
+    for dim in range(ch):
+        for idx1 in range(d1):
+            for idx2 in range(d2):
+                label = clusters[dim, idx1, idx2]
+                if label > 0:
+                    label = final[label]
+                    clusters[dim, idx1, idx2] = label
+                    cluster_stats[label - 1] += stat[dim, idx1, idx2]
 
-    return clusters
+    return clusters, cluster_stats
 
 
 # - [ ] this is mostly for tests
 def find_neighbours(adj):
-    n_ch = len(adj)
+    indptr, indices = adjacency_to_csr(adj)
     neighbours = list()
-    for idx in range(1, n_ch):
-        neighbours.append(np.nonzero(adj[idx, :idx])[0])
+    for idx in range(1, len(indptr) - 1):
+        ngb = indices[indptr[idx]:indptr[idx + 1]]
+        neighbours.append(ngb[ngb < idx])
     return neighbours
 
 
-@jit(nopython=True)
-def find_neighbours_numba(adj):
-    n_ch = len(adj)
-    neighbours = list()
-    for idx in range(1, n_ch):
-        neighbours.append(np.nonzero(adj[idx, :idx])[0])
-    return neighbours
-
-
-# - [ ] neighbouring_clusters is bad will all the concatenations...
-#       maybe construct list and only then turn to array
-# - [ ] removed correspondence
-@jit(nopython=True)
-def _check_neighbours_numba(clusters, neighbours, ch, idx1, idx2):
-    neighbouring_clusters = [np.int64(x) for x in range(0)]
-
-    # adjacency-defined layer
-    if ch > 0:
-        ngb = neighbours[ch - 1]
-        if len(ngb) > 0:
-            neighbouring_clusters += unique_nonzero(clusters[ngb, idx1, idx2])
-
-    # idx1 layer
-    if idx1 > 0:
-        val = clusters[ch, idx1 - 1, idx2]
-        if val > 0:
-            neighbouring_clusters.append(val)
-
-    # idx2 layer
-    if idx2 > 0:
-        val = clusters[ch, idx1, idx2 - 1]
-        if val > 0:
-            neighbouring_clusters.append(val)
-
-    if len(neighbouring_clusters) > 0:
-        neighbouring_clusters = unique(neighbouring_clusters)
-
-    # fill correspondence
-    # if len(neighbouring_clusters) > 1:
-    #     _handle_correspondence(correspondence, neighbouring_clusters)
-
-    return neighbouring_clusters
-
-
-@jit(nopython=True)
-def is_in_array(element, array):
-    for val in array:
-        if element == val:
-            return True
-    return False
-
-
-@jit(nopython=True)
-def unique_nonzero(ngb):
-    """Return unique non-zero values from vector."""
-    uni = list()
-    for n in ngb:
-        if n > 0 and n not in uni:
-            uni.append(n)
-    return uni
-
-
-@jit(nopython=True)
-def unique(ngb):
-    """Return unique values from vector."""
-    uni = list()
-    for n in ngb:
-        if n not in uni:
-            uni.append(n)
-    return uni
-
-
-# - [ ] cleanup names
-@jit(nopython=True)
-def _handle_correspondence(correspondence, same_clusters):
-    if len(correspondence) == 0:
-        correspondence.append(same_clusters)
-    else:
-        isin = list()
-        nopair = list()
-        for clst_idx in same_clusters:
-            this_nopair = True
-            for idx, group in enumerate(correspondence):
-                if is_in_array(clst_idx, group):
-                    isin.append(idx)
-                    this_nopair = False
-                    break
-            nopair.append(this_nopair)
-
-        if len(isin) == 0:
-            correspondence.append(same_clusters)
+def tfce_3d(stat, adj, start=0., step=0.2, e_power=0.5, h_power=2.):
+    '''Threshold-free cluster enhancement of three-dimensional data.
+
+    Cluster extents are computed incrementally for the whole threshold ladder
+    in one sweep: data points are added from the highest to the lowest value
+    and clusters are joined with union-find when the threshold drops. The
+    enhancement of each cluster is accumulated on the root of its union-find
+    tree, so no relabeling is done at any threshold.
+
+    Each threshold ``h`` contributes ``dh * h ** h_power * e ** e_power``,
+    where ``e`` is the cluster extent and ``dh`` is the distance to the
+    previous threshold. For the lowest threshold ``dh`` is the distance from
+    zero (``start``, not ``step``), so with ``start > 0`` the slice below the
+    ladder is counted once. This is the same rule as in
+    ``mne.stats.cluster_level._find_clusters`` of recent MNE versions (TFCE
+    maps of two-dimensional data); a brute-force sum using ``step`` for every
+    threshold gives different values when ``start > 0``.
+
+    Parameters
+    ----------
+    stat : numpy array
+        Statistical map of shape ``(n_channels, dim2, dim3)``.
+    adj : numpy array | scipy sparse matrix | tuple of numpy arrays
+        Boolean channel adjacency matrix or ``(indptr, indices)`` CSR
+        neighbour arrays returned by ``adjacency_to_csr``.
+    start : float
+        First threshold of the ladder. Its slice height is ``start`` (see
+        above).
+    step : float
+        Distance between consecutive thresholds.
+    e_power : float
+        Exponent of the cluster extent.
+    h_power : float
+        Exponent of the threshold height.
+
+    Returns
+    -------
+    tfce : numpy array
+        TFCE map of the same shape as ``stat``. Positive values correspond to
+        enhancement of positive ``stat`` values, negative values - to
+        enhancement of negative ``stat`` values.
+    '''
+    indptr, indices = _check_csr(adj)
+    stat = np.ascontiguousarray(stat, dtype=np.float64)
+
+    tfce = np.zeros(stat.shape)
+    for sign in [1., -1.]:
+        this_stat = stat * sign
+        stop = this_stat.max()
+        thresholds = np.arange(start, stop, step, dtype=np.float64)
+        if thresholds.shape[0] > 0:
+            tfce += sign * _tfce_3d_numba(this_stat, indptr, indices,
+                                          thresholds, float(e_power),
+                                          float(h_power))
+    return tfce
+
+
+@jit('int64(int64[::1], float64[::1], int64[::1], int64)', nopython=True,
+     cache=True)
+def _find_root_acc(parents, acc, path, idx):
+    '''Find root of the point's tree, compressing the path and keeping
+    accumulated values of the compressed nodes relative to the root.'''
+    n_path = 0
+    while parents[idx] != idx:
+        path[n_path] = idx
+        n_path += 1
+        idx = parents[idx]
+    root = idx
+
+    cumulative = 0.
+    for path_idx in range(n_path - 1, -1, -1):
+        node = path[path_idx]
+        cumulative += acc[node]
+        acc[node] = cumulative
+        parents[node] = root
+    return root
+
+
+@jit(_tfce_union_sig, nopython=True, cache=True)
+def _tfce_union(idx, ngb, parents, sizes, acc, added, path, roots, root_pos,
+                n_roots):
+    '''Join trees of point ``idx`` and its neighbour ``ngb``.'''
+    if not added[ngb]:
+        return n_roots
+
+    root1 = _find_root_acc(parents, acc, path, idx)
+    root2 = _find_root_acc(parents, acc, path, ngb)
+    if root1 == root2:
+        return n_roots
+
+    # attach smaller tree to the bigger one
+    if sizes[root1] > sizes[root2]:
+        root1, root2 = root2, root1
+    parents[root1] = root2
+    acc[root1] -= acc[root2]
+    sizes[root2] += sizes[root1]
+
+    # remove root1 from the list of roots
+    last = roots[n_roots - 1]
+    roots[root_pos[root1]] = last
+    root_pos[last] = root_pos[root1]
+    return n_roots - 1
+
+
+@jit(_tfce_sig, nopython=True, cache=True)
+def _tfce_3d_numba(stat, indptr, indices, thresholds, e_power, h_power):
+    ch, d1, d2 = stat.shape
+    n_points = stat.size
+    n_layer = d1 * d2
+    flat_stat = stat.ravel()
+    order = np.argsort(-flat_stat)
+
+    # union-find forest; acc holds the enhancement of each node relative to
+    # its parent - enhancement of a point is the sum of acc on its path
+    parents = np.arange(n_points)
+    sizes = np.zeros(n_points, dtype=np.int64)
+    acc = np.zeros(n_points, dtype=np.float64)
+    added = np.zeros(n_points, dtype=np.bool_)
+    path = np.empty(n_points, dtype=np.int64)
+
+    # list of current roots with O(1) removal
+    roots = np.empty(n_points, dtype=np.int64)
+    root_pos = np.empty(n_points, dtype=np.int64)
+    n_roots = 0
+
+    pos = 0
+    for thresh_idx in range(thresholds.shape[0] - 1, -1, -1):
+        thresh = thresholds[thresh_idx]
+
+        # add points exceeding the threshold and join them with neighbours
+        while pos < n_points and flat_stat[order[pos]] > thresh:
+            idx = order[pos]
+            pos += 1
+            added[idx] = True
+            sizes[idx] = 1
+            roots[n_roots] = idx
+            root_pos[idx] = n_roots
+            n_roots += 1
+
+            dim = idx // n_layer
+            idx1 = (idx % n_layer) // d2
+            idx2 = idx % d2
+            if idx1 > 0:
+                n_roots = _tfce_union(idx, idx - d2, parents, sizes, acc,
+                                      added, path, roots, root_pos, n_roots)
+            if idx1 < d1 - 1:
+                n_roots = _tfce_union(idx, idx + d2, parents, sizes, acc,
+                                      added, path, roots, root_pos, n_roots)
+            if idx2 > 0:
+                n_roots = _tfce_union(idx, idx - 1, parents, sizes, acc,
+                                      added, path, roots, root_pos, n_roots)
+            if idx2 < d2 - 1:
+                n_roots = _tfce_union(idx, idx + 1, parents, sizes, acc,
+                                      added, path, roots, root_pos, n_roots)
+            for ngb_idx in range(indptr[dim], indptr[dim + 1]):
+                ngb = idx + (indices[ngb_idx] - dim) * n_layer
+                n_roots = _tfce_union(idx, ngb, parents, sizes, acc,
+                                      added, path, roots, root_pos, n_roots)
+
+        # enhance all current clusters, the lowest slice reaches down to zero
+        # (as in mne's TFCE)
+        if thresh_idx > 0:
+            height = thresh - thresholds[thresh_idx - 1]
         else:
-            isin = unique(isin)
-
-            if len(isin) == 1:
-                # just join those not present:
-                new_clst_id = same_clusters[np.array(nopair)]
-                if len(new_clst_id) > 0:
-                    comp = isin[0]
-                    correspondence[comp] = np.concatenate(
-                        (correspondence[comp], new_clst_id))
-            else:
-                first = isin[0]
-                # merge and remove
-                for idx in isin[1:][::-1]:
-                    correspondence[first] = np.concatenate(
-                        (correspondence[first], correspondence.pop(idx)))
-
-                new_clst_id = same_clusters[np.array(nopair)]
-                if len(new_clst_id) > 0:
-                    correspondence[first] = np.concatenate(
-                        (correspondence[first], new_clst_id))
-
-
-# - [ ] clean up relabel
-def _relabel():
-    relabel = np.arange(0, last_clst + 1)
-    # full relabel
-    for corresp in csp:
-        first = corresp[0]
-        for rename in corresp[1:]:
-            relabel[rename] = first
-
-    last_max = 0
-    for idx, el in enumerate(relabel):
-        diff = el - last_max
-        if diff == 1:
-            last_max = el
-        if diff > 1:
-            last_max += 1
-            relabel[idx] = last_max
-
-
-# - [ ] move to tests
-def test_uniques():
-    unsifted1 = np.array([0, 0, 1, 0, 2, 0, 1, 0, 0, 3, 1, 0, 2, 0, 0, 4])
-    unsifted2 = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0])
-
-    assert np.array(unique(unsifted1)) == np.array([0, 1, 2, 3, 4])
-    assert np.array(unique_nonzero(unsifted1)) == np.array([1, 2, 3, 4])
-    assert np.array(unique(unsifted2)) == np.array([0])
-    assert np.array(unique_nonzero(unsifted2)) == np.array([])
+            height = abs(thresh)
+        height *= abs(thresh) ** h_power
+        for root_idx in range(n_roots):
+            root = roots[root_idx]
+            acc[root] += height * sizes[root] ** e_power
+
+    tfce = np.zeros(n_points, dtype=np.float64)
+    for idx in range(n_points):
+        if added[idx]:
+            root = _find_root_acc(parents, acc, path, idx)
+            tfce[idx] = acc[idx] if root == idx else acc[idx] + acc[root]
+    return tfce.reshape(stat.shape)
+
+
+def filter_clusters_3d(mat, indptr, indices, min_neighbours, min_channels):
+    '''Remove cluster points with too few neighbours in one pass.
+
+    See ``sarna.cluster.filter_clusters`` for description. Channel neighbours
+    are given as CSR ``indptr`` and ``indices`` arrays.
+    '''
+    mat = np.ascontiguousarray(mat, dtype=np.bool_)
+    indptr, indices = _check_csr((indptr, indices))
+    return _filter_clusters_3d_numba(mat, indptr, indices,
+                                     int(min_neighbours), int(min_channels))
+
+
+@jit('boolean(boolean[:, :, ::1], int64, int64, int64, int64)',
+     nopython=True, cache=True)
+def _enough_neighbours(mat, dim, idx1, idx2, min_neighbours):
+    '''Check if in-cluster point has enough in-cluster neighbours within its
+    channel.'''
+    if not mat[dim, idx1, idx2]:
+        return False
+
+    d1, d2 = mat.shape[1:]
+    n_neighbours = 0
+    for ngb1 in range(max(idx1 - 1, 0), min(idx1 + 2, d1)):
+        for ngb2 in range(max(idx2 - 1, 0), min(idx2 + 2, d2)):
+            if mat[dim, ngb1, ngb2]:
+                n_neighbours += 1
+    # the point itself was counted too
+    return n_neighbours - 1 >= min_neighbours
+
+
+@jit(_filter_sig, nopython=True, cache=True)
+def _filter_clusters_3d_numba(mat, indptr, indices, min_neighbours,
+                              min_channels):
+    ch, d1, d2 = mat.shape
+    out = np.zeros((ch, d1, d2), dtype=np.bool_)
+
+    for dim in range(ch):
+        for idx1 in range(d1):
+            for idx2 in range(d2):
+                if not _enough_neighbours(mat, dim, idx1, idx2,
+                                          min_neighbours):
+                    continue
+
+                if min_channels > 0:
+                    n_channels = 0
+                    for ngb_idx in range(indptr[dim], indptr[dim + 1]):
+                        if _enough_neighbours(mat, indices[ngb_idx], idx1,
+                                              idx2, min_neighbours):
+                            n_channels += 1
+                    if n_channels < min_channels:
+                        continue
+                out[dim, idx1, idx2] = True
+    return out
+
+
+def warmup():
+    '''Compile all numba kernels and fill the on-disk compilation cache.
+
+    The kernels are compiled (or loaded from the cache) when the module is
+    imported. ``warmup`` additionally runs every kernel on a tiny problem, so
+    it can be used at container or environment build time to make sure the
+    cache is filled and usable, for example::
+
+        python -c "import sarna.cluster_numba as cn; cn.warmup()"
+
+    If the ``NUMBA_CACHE_DIR`` environment variable is set, the cache is
+    always stored in that directory (set it to the same value at build time
+    and at run time). Otherwise the cache is stored next to the module or,
+    if that location is not writable, in numba's user-wide cache directory
+    (for example ``~/.cache/numba``).
+    '''
+    adj = np.array([[False, True], [True, False]])
+    stat = np.arange(-12., 12.).reshape((2, 3, 4))
+    indptr, indices = adjacency_to_csr(adj)
+
+    find_clusters_3d(stat > 0, (indptr, indices), stat=stat)
+    tfce_3d(stat, (indptr, indices), step=1.)
+    filter_clusters_3d(stat > 0, indptr, indices, 1, 1)
@@ -25,6 +25,133 @@ def ttest_rel_no_p(*args):
     return t
 
 
+def ttest_1samp_sign_flip_no_p(data, signs, sum_sq=None):
+    '''One-sample t test for many sign-flips of the data at once.
+
+    The sum of squares does not change when signs of the observations are
+    flipped, so only the sums have to be computed for each sign-flip. These
+    are obtained with one matrix product: ``signs @ data``.
+
+    Parameters
+    ----------
+    data : numpy array
+        Data array of shape ``(n_observations, n_features)``.
+    signs : numpy array
+        Sign-flip array of shape ``(n_flips, n_observations)`` with values
+        ``-1`` or ``1``.
+    sum_sq : numpy array | None
+        Sum of squares of the data along the observations dimension. Computed
+        when not given.
+
+    Returns
+    -------
+    t : numpy array
+        t values of shape ``(n_flips, n_features)``.
+    '''
+    n_obs = data.shape[0]
+    if sum_sq is None:
+        sum_sq = (data ** 2).sum(axis=0)
+
+    return ttest_1samp_from_sums(signs @ data, sum_sq, n_obs)
+
+
+def ttest_1samp_from_sums(sums, sum_sq, n_obs):
+    '''One-sample t test from sums and sums of squares of the observations.
+
+    Parameters
+    ----------
+    sums : numpy array
+        Sums of the observations, for example of shape
+        ``(n_flips, n_features)`` for many sign-flips.
+    sum_sq : numpy array
+        Sums of squares of the observations.
+    n_obs : int
+        Number of observations.
+
+    Returns
+    -------
+    t : numpy array
+        t values, of the same shape as ``sums``.
+    '''
+    mean = sums / n_obs
+    var = (sum_sq - sums * mean) / (n_obs - 1)
+    return mean / np.sqrt(var / n_obs)
+
+
+def ttest_ind_permuted_no_p(data, group1, data_sq=None, totals=None):
+    '''Independent samples t test for many permutations of group labels.
+
+    Group sums and sums of squares are obtained by reducing the data over
+    the observations assigned to the first group in each permutation
+    (a product of group membership matrix and the data). The second group
+    sums are the differences from the totals, so the permuted data are never
+    built.
+
+    Parameters
+    ----------
+    data : numpy array
+        Data of both groups, array of shape ``(n_observations, n_features)``.
+    group1 : numpy array
+        Integer array of shape ``(n_permutations, n_observations_group1)``
+        with indices of observations belonging to the first group in each
+        permutation.
+    data_sq : numpy array | None
+        Squared data. Computed when not given.
+    totals : tuple of numpy arrays | None
+        Sums and sums of squares of all the observations. Computed when not
+        given.
+
+    Returns
+    -------
+    t : numpy array
+        t values of shape ``(n_permutations, n_features)``.
+    '''
+    n_perm, n1 = group1.shape
+    n_obs = data.shape[0]
+    if data_sq is None:
+        data_sq = data ** 2
+
+    if totals is None:
+        totals = (data.sum(axis=0), data_sq.sum(axis=0))
+
+    member = np.zeros((n_perm, n_obs))
+    member[np.arange(n_perm)[:, np.newaxis], group1] = 1.
+    return ttest_ind_from_sums(member @ data, member @ data_sq, *totals, n1,
+                               n_obs)
+
+
+def ttest_ind_from_sums(sum1, sum_sq1, sum_all, sum_sq_all, n1, n_obs):
+    '''Independent samples t test from sums and sums of squares.
+
+    Parameters
+    ----------
+    sum1 : numpy array
+        Sums of the first group observations, for example of shape
+        ``(n_permutations, n_features)`` for many permutations.
+    sum_sq1 : numpy array
+        Sums of squares of the first group observations.
+    sum_all : numpy array
+        Sums of all the observations (both groups).
+    sum_sq_all : numpy array
+        Sums of squares of all the observations (both groups).
+    n1 : int
+        Number of observations in the first group.
+    n_obs : int
+        Number of all the observations.
+
+    Returns
+    -------
+    t : numpy array
+        t values, of the same shape as ``sum1``.
+    '''
+    n2 = n_obs - n1
+    sum2 = sum_all - sum1
+    sum_sq2 = sum_sq_all - sum_sq1
+
+    var = (sum_sq1 - sum1 ** 2 / n1 + sum_sq2 - sum2 ** 2 / n2) / (n_obs - 2)
+    return (sum1 / n1 - sum2 / n2) / np.sqrt(var * (1 / n1 + 1 / n2))
+
+
 # TODO:
 # - [x] seems that y has to be a vector now, adapt for matrix - matrix
 #       (done for Pearson)